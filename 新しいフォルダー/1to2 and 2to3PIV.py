@@ -1,42 +1,27 @@
 import os
-import glob
-import re
 import time
-import subprocess
 import keyboard
 import pyautogui
-import json
 import uuid
+from piv_jobs import PivJob, JobScheduler, standin_command, print_summary, DEFAULT_MAX_CONCURRENCY, STANDIN_COMMAND_ENV
+from piv_registry import InstanceRegistry, REGISTRY_NAME
+from bmp_sequence import get_folders_with_bmp, bmp_sequence_info, create_save_folder
+from piv_pairs import plan_pairs, consecutive_runs, PAIRING_CONSECUTIVE, PAIRING_STRIDED, PAIRING_AB, PAIRING_SLIDING
 
-RUNNING_INSTANCES_FILE = "running_instances.json"
 TEMP_ROOT_FOLDER = os.path.join(os.environ['LOCALAPPDATA'], "Temp", "PIV_Global")
 
 if not os.path.exists(TEMP_ROOT_FOLDER):
     os.makedirs(TEMP_ROOT_FOLDER, exist_ok=True)
 
-def load_running_instances():
-    """ 現在実行中のPIVインスタンスをロードする """
-    if os.path.exists(RUNNING_INSTANCES_FILE):
-        with open(RUNNING_INSTANCES_FILE, "r") as f:
-            return json.load(f)
-    return {}
-
-def save_running_instances(instances):
-    """ 実行中のPIVインスタンス情報を保存する """
-    with open(RUNNING_INSTANCES_FILE, "w") as f:
-        json.dump(instances, f, indent=4)
-
-def cleanup_finished_instances():
-    """ すでに終了しているPIVインスタンスをリストから削除 """
-    instances = load_running_instances()
-    active_instances = {}
-    
-    for key, info in instances.items():
-        pid = info.get("pid")
-        if pid and is_process_running(pid):
-            active_instances[key] = info
-    
-    save_running_instances(active_instances)
+# 実行中・終了したPIVインスタンスの記録（同時に起動した他のランチャーと共有する）
+REGISTRY_PATH = os.path.join(TEMP_ROOT_FOLDER, REGISTRY_NAME)
+
+# 組の作り方の選択肢
+PAIRING_CHOICES = {"1": PAIRING_CONSECUTIVE, "2": PAIRING_STRIDED, "3": PAIRING_AB, "4": PAIRING_SLIDING}
+
+def cleanup_finished_instances(registry):
+    """ すでに終了しているPIVインスタンスを終了済みにする """
+    registry.cleanup_finished(is_process_running)
 
 def is_process_running(pid):
     """ 指定したPIDのプロセスが実行中か確認 """
@@ -54,88 +39,65 @@ def get_unique_temp_folder():
             os.makedirs(temp_folder, exist_ok=True)
             return temp_folder
 
-def get_folders_with_bmp(base_path):
-    """ 指定フォルダ内のフォルダを取得し、bmpファイルがあるフォルダのみ返す """
-    folder_paths = [os.path.abspath(f) for f in glob.glob(os.path.join(base_path, '*')) if os.path.isdir(f)]
-    valid_folders = []
-    
-    for folder in folder_paths:
-        bmp_files = glob.glob(os.path.join(folder, '*.bmp'))
-        if bmp_files:
-            valid_folders.append(folder)
-    
-    return valid_folders
-
-def extract_common_name_and_final_num(folder):
-    """ フォルダ内のbmpファイルから共通名(name)と最終番号(final_num)を取得 """
-    bmp_files = glob.glob(os.path.join(folder, '*.bmp'))
-    if not bmp_files:
-        return None, None
-
-    pattern = re.compile(r'^(.*?)(\d{6})\.bmp$')
-    file_info = []
-    
-    for file in bmp_files:
-        filename = os.path.basename(file)
-        match = pattern.match(filename)
-        if match:
-            base_name, number = match.groups()
-            file_info.append((base_name, int(number)))
-    
-    if not file_info:
-        return None, None
-    
-    file_info.sort(key=lambda x: x[1])
-    final_num = file_info[-1][1]
-    
-    return file_info[0][0], final_num
-
-def launch_piv_instance(bpass, name, final_num, savefolder_pass):
-    """ PIVソフトを起動し、競合を防ぐ """
-    cleanup_finished_instances()
-    temp_folder = get_unique_temp_folder()
-    
-    env = os.environ.copy()
-    env["TEMP"] = temp_folder
-    env["TMP"] = temp_folder
-
+def piv_command(job):
+    """ PIVソフトを起動するコマンド（start /wait でPIVソフトが終了するまで待つ） """
     user_profile = os.environ['USERPROFILE']
     shortcut_path = os.path.abspath(os.path.join(user_profile, r'AppData\Roaming\Microsoft\Windows\Start Menu\Programs\PIV\PIV.lnk'))
-    
-    process = subprocess.Popen(['cmd', '/c', 'start', '', shortcut_path], shell=True, env=env)
-    pid = process.pid
-    
-    instances = load_running_instances()
-    instances[temp_folder] = {"pid": pid, "bpass": bpass, "name": name, "final_num": final_num, "savefolder_pass": savefolder_pass}
-    save_running_instances(instances)
-    
+    return ['cmd', '/c', 'start', '/wait', '', shortcut_path]
+
+def piv_environment(job):
+    """ ジョブごとのテンポラリフォルダを TEMP/TMP にした環境変数を作り、競合を防ぐ """
+    cleanup_finished_instances(registry)
+    job.temp_folder = get_unique_temp_folder()
+
+    env = os.environ.copy()
+    env["TEMP"] = job.temp_folder
+    env["TMP"] = job.temp_folder
+    return env
+
+def register_instance(job):
+    """ 起動したPIVインスタンスを記録する """
+    job.registry_id = registry.add(job.pid, job.bpass, job.name, job.final_num, job.b_savefolder_pass,
+                                   temp_folder=job.temp_folder, experiment=os.path.dirname(job.bpass))
+    print(f"PIV を {job.temp_folder} の環境で起動しました (PID: {job.pid})")
+
+def record_finished(job):
+    """ 終わったPIVインスタンスの終了状態を記録する """
+    if job.registry_id is not None:
+        registry.update_status(job.registry_id, job.status, job.returncode)
+
+def launch_piv_instance(job):
+    """ 起動したPIVソフトに組の区間を入力してPIVを開始する """
+    register_instance(job)
     time.sleep(1)
-    print(f"PIV を {temp_folder} の環境で起動しました (PID: {pid})")
-    
+
     # TABキー3回
     pyautogui.press('tab', presses=3)
 
     # Bpassを入力
-    print(f"入力するBpass: {bpass}")
-    keyboard.write(bpass)
+    print(f"入力するBpass: {job.bpass}")
+    keyboard.write(job.bpass)
     pyautogui.press('tab', presses=2)
 
     # nameを入力
-    print(f"入力するName: {name}")
-    keyboard.write(name)
+    print(f"入力するName: {job.name}")
+    keyboard.write(job.name)
     pyautogui.press('tab', presses=3)
 
-    # first_numberを入力
-    keyboard.write("1")
-    pyautogui.press('tab', presses=1)           
+    # 最初の組の1枚目の番号を入力
+    print(f"入力するfirst_number: {job.first_number}")
+    keyboard.write(job.first_number)
+    pyautogui.press('tab', presses=1)
 
-    # final_num - 1 を入力
-    keyboard.write("2")
+    # 最後の組の1枚目の番号を入力
+    final_input_num = str(job.final_num - 1)
+    print(f"入力するFinalNum: {final_input_num}")
+    keyboard.write(final_input_num)
     pyautogui.press('tab', presses=7)
 
-    # savefolder_passを入力
-    print(f"入力するsavefolder_pass: {savefolder_pass}")
-    keyboard.write(savefolder_pass)
+    # B_savefolder_passを入力
+    print(f"入力するB_savefolder_pass: {job.b_savefolder_pass}")
+    keyboard.write(job.b_savefolder_pass)
 
     # ファイル読み込み
     pyautogui.press('tab', presses=3)
@@ -148,95 +110,59 @@ def launch_piv_instance(bpass, name, final_num, savefolder_pass):
     pyautogui.press('tab', presses=4)
     pyautogui.press('enter')
 
+def plan_jobs(bpass, b_savefolder_pass, info, first_number, final_num, pairing, stride, span):
+    """
+    組の計画を、PIVソフトに渡せる区間（n→n+1 が続く範囲）ごとのジョブにする。
+    区間ごとに1回起動するので、隣り合う組で共有する画像（1→2, 2→3 の 2 など）は1回しか読まれない。
+    """
+    pairs = plan_pairs(first_number, final_num, pairing, stride, span, info["missing"])
+    unsupported = [(a, b) for a, b in pairs if b - a != 1]
+    if unsupported:
+        # PIVソフトは連続した画像の組しか扱えないので、間隔が1でない組は ver2.0 で処理する
+        print(f"{info['name']}: 間隔が1でない {len(unsupported)} 組はPIVソフトでは処理できません"
+              f"（Automatic Multiple PIV ver2.0.py を使ってください）")
+    return [PivJob(bpass, info["name"], str(first), last + 1, b_savefolder_pass)
+            for first, last in consecutive_runs(pairs)]
+
 if __name__ == '__main__':
     apass = input("bmpファイルが入ったフォルダが複数入っている親フォルダのパス(Apass)を入力してください: ").strip()
     savefolder_pass = input("保存先のフォルダパス(savefolder_pass)を入力してください: ").strip()
+    first_number = int(input("1枚目番号(first_number)を入力してください [1]:").strip() or "1")
+    final_input = int(input("最後の画像の番号を入力してください（0 でフォルダの最後まで） [3]: ").strip() or "3")
+    pairing = PAIRING_CHOICES.get(input("組の作り方を選択 (1: 連続 n→n+1, 2: 間隔指定 n→n+s, 3: ダブルフレーム 1→2, 3→4, ..., 4: スライディング n→n+1〜n+k) [1]: ").strip() or "1", PAIRING_CONSECUTIVE)
+    stride = span = 1
+    if pairing == PAIRING_STRIDED:
+        stride = int(input("組の間隔 s を入力してください [2]: ").strip() or "2")
+    elif pairing == PAIRING_SLIDING:
+        span = int(input("組にする最大の間隔 k を入力してください [2]: ").strip() or "2")
+    max_concurrency = int(input(f"同時に実行するPIVの数を入力してください [{DEFAULT_MAX_CONCURRENCY}]: ").strip() or DEFAULT_MAX_CONCURRENCY)
 
     apass = os.path.abspath(apass)
     savefolder_pass = os.path.abspath(savefolder_pass)
-    
+
     valid_folders = get_folders_with_bmp(apass)
-    
+    registry = InstanceRegistry(REGISTRY_PATH)
+
     if not valid_folders:
         print("BMPファイルのあるフォルダが見つかりませんでした。")
     else:
+        # 環境変数 PIV_COMMAND があれば、PIVソフトの代わりにそのコマンドを実行する（テスト用）
+        standin = os.environ.get(STANDIN_COMMAND_ENV)
+        if standin:
+            scheduler = JobScheduler(standin_command(standin), max_concurrency, env=piv_environment, on_start=register_instance, on_finish=record_finished)
+        else:
+            scheduler = JobScheduler(piv_command, max_concurrency, env=piv_environment, on_start=launch_piv_instance, on_finish=record_finished, shell=True)
+
         for bpass in valid_folders:
             bpass = os.path.abspath(bpass)
-            name, final_num = extract_common_name_and_final_num(bpass)
-            
-            if name and final_num:
-                launch_piv_instance(bpass, name, final_num, savefolder_pass)
-
-def launch_piv_instance(bpass, name, final_num, savefolder_pass):
-    """ PIVソフトを起動し、競合を防ぐ """
-    cleanup_finished_instances()
-    temp_folder = get_unique_temp_folder()
-    
-    env = os.environ.copy()
-    env["TEMP"] = temp_folder
-    env["TMP"] = temp_folder
-
-    user_profile = os.environ['USERPROFILE']
-    shortcut_path = os.path.abspath(os.path.join(user_profile, r'AppData\Roaming\Microsoft\Windows\Start Menu\Programs\PIV\PIV.lnk'))
-    
-    process = subprocess.Popen(['cmd', '/c', 'start', '', shortcut_path], shell=True, env=env)
-    pid = process.pid
-    
-    instances = load_running_instances()
-    instances[temp_folder] = {"pid": pid, "bpass": bpass, "name": name, "final_num": final_num, "savefolder_pass": savefolder_pass}
-    save_running_instances(instances)
-    
-    time.sleep(1)
-    print(f"PIV を {temp_folder} の環境で起動しました (PID: {pid})")
-    
-    # TABキー3回
-    pyautogui.press('tab', presses=3)
-
-    # Bpassを入力
-    print(f"入力するBpass: {bpass}")
-    keyboard.write(bpass)
-    pyautogui.press('tab', presses=2)
-
-    # nameを入力
-    print(f"入力するName: {name}")
-    keyboard.write(name)
-    pyautogui.press('tab', presses=3)
-
-    # first_numberを入力
-    keyboard.write("2")
-    pyautogui.press('tab', presses=1)
+            info = bmp_sequence_info(bpass)
+            if info is None or info["name"] is None:
+                continue
+            b_savefolder_pass = create_save_folder(savefolder_pass, bpass)
+            final_num = min(final_input, info["last"]) if final_input else info["last"]
 
-    # final_num - 1 を入力
-    keyboard.write("3")
-    pyautogui.press('tab', presses=7)
+            for job in plan_jobs(bpass, b_savefolder_pass, info, first_number, final_num, pairing, stride, span):
+                scheduler.submit(job)
 
-    # savefolder_passを入力
-    print(f"入力するsavefolder_pass: {savefolder_pass}")
-    keyboard.write(savefolder_pass)
-
-    # ファイル読み込み
-    pyautogui.press('tab', presses=3)
-    pyautogui.press('enter')
-
-    # ファイルの読み込みが終わるまで待機（状況によって調整が必要）
-    time.sleep(1)
-
-    #PIV開始
-    pyautogui.press('tab', presses=4)
-    pyautogui.press('enter')
-
-if __name__ == '__main__':
-    apass = os.path.abspath(apass)
-    savefolder_pass = os.path.abspath(savefolder_pass)
-    
-    valid_folders = get_folders_with_bmp(apass)
-    
-    if not valid_folders:
-        print("BMPファイルのあるフォルダが見つかりませんでした。")
-    else:
-        for bpass in valid_folders:
-            bpass = os.path.abspath(bpass)
-            name, final_num = extract_common_name_and_final_num(bpass)
-            
-            if name and final_num:
-                launch_piv_instance(bpass, name, final_num, savefolder_pass)
\ No newline at end of file
+        print_summary(scheduler.run())
+        print(f"この実験の記録: {registry.summary(apass)}")
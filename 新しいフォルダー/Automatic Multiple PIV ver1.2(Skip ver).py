@@ -1,42 +1,24 @@
 import os
-import glob
-import re
 import time
 import subprocess
 import keyboard
 import pyautogui
-import json
 import uuid
+from piv_registry import InstanceRegistry, REGISTRY_NAME
+from bmp_sequence import get_folders_with_bmp, bmp_sequence_info, print_bmp_report, create_save_folder
+from piv_pairs import plan_pairs, consecutive_runs
 
-RUNNING_INSTANCES_FILE = "running_instances.json"
 TEMP_ROOT_FOLDER = os.path.join(os.environ['LOCALAPPDATA'], "Temp", "PIV_Global")
 
 if not os.path.exists(TEMP_ROOT_FOLDER):
     os.makedirs(TEMP_ROOT_FOLDER, exist_ok=True)
 
-def load_running_instances():
-    """ 現在実行中のPIVインスタンスをロードする """
-    if os.path.exists(RUNNING_INSTANCES_FILE):
-        with open(RUNNING_INSTANCES_FILE, "r") as f:
-            return json.load(f)
-    return {}
-
-def save_running_instances(instances):
-    """ 実行中のPIVインスタンス情報を保存する """
-    with open(RUNNING_INSTANCES_FILE, "w") as f:
-        json.dump(instances, f, indent=4)
-
-def cleanup_finished_instances():
-    """ すでに終了しているPIVインスタンスをリストから削除 """
-    instances = load_running_instances()
-    active_instances = {}
-    
-    for key, info in instances.items():
-        pid = info.get("pid")
-        if pid and is_process_running(pid):
-            active_instances[key] = info
-    
-    save_running_instances(active_instances)
+# 実行中・終了したPIVインスタンスの記録（同時に起動した他のランチャーと共有する）
+REGISTRY_PATH = os.path.join(TEMP_ROOT_FOLDER, REGISTRY_NAME)
+
+def cleanup_finished_instances(registry):
+    """ すでに終了しているPIVインスタンスを終了済みにする """
+    registry.cleanup_finished(is_process_running)
 
 def is_process_running(pid):
     """ 指定したPIDのプロセスが実行中か確認 """
@@ -54,52 +36,9 @@ def get_unique_temp_folder():
             os.makedirs(temp_folder, exist_ok=True)
             return temp_folder
 
-def get_folders_with_bmp(base_path):
-    """ 指定フォルダ内のフォルダを取得し、bmpファイルがあるフォルダのみ返す """
-    folder_paths = [os.path.abspath(f) for f in glob.glob(os.path.join(base_path, '*')) if os.path.isdir(f)]
-    valid_folders = []
-    
-    for folder in folder_paths:
-        bmp_files = glob.glob(os.path.join(folder, '*.bmp'))
-        if bmp_files:
-            valid_folders.append(folder)
-    
-    return valid_folders
-
-def extract_common_name_and_final_num(folder):
-    """ フォルダ内のbmpファイルから共通名(name)と最終番号(final_num)を取得 """
-    bmp_files = glob.glob(os.path.join(folder, '*.bmp'))
-    if not bmp_files:
-        return None, None
-
-    pattern = re.compile(r'^(.*?)(\d{6})\.bmp$')
-    file_info = []
-    
-    for file in bmp_files:
-        filename = os.path.basename(file)
-        match = pattern.match(filename)
-        if match:
-            base_name, number = match.groups()
-            file_info.append((base_name, int(number)))
-    
-    if not file_info:
-        return None, None
-    
-    file_info.sort(key=lambda x: x[1])
-    final_num = file_info[-1][1]
-    
-    return file_info[0][0], final_num
-
-def create_save_folder(savefolder_pass, bpass):
-    """ Bpassの最終フォルダ名と同じフォルダを savefolder_pass に作成 """
-    folder_name = os.path.basename(bpass)
-    save_path = os.path.join(savefolder_pass, folder_name)
-    os.makedirs(save_path, exist_ok=True)
-    return save_path
-
-def launch_piv_instance(bpass, name, final_num, b_savefolder_pass, first_number):
+def launch_piv_instance(registry, bpass, name, final_num, b_savefolder_pass, first_number):
     """ PIVソフトを起動し、自動入力を行う """
-    cleanup_finished_instances()
+    cleanup_finished_instances(registry)
     temp_folder = get_unique_temp_folder()
     
     env = os.environ.copy()
@@ -112,9 +51,7 @@ def launch_piv_instance(bpass, name, final_num, b_savefolder_pass, first_number)
     process = subprocess.Popen(['cmd', '/c', 'start', '', shortcut_path], shell=True, env=env)
     pid = process.pid
     
-    instances = load_running_instances()
-    instances[temp_folder] = {"pid": pid, "bpass": bpass, "name": name, "final_num": final_num, "b_savefolder_pass": b_savefolder_pass}
-    save_running_instances(instances)
+    registry.add(pid, bpass, name, final_num, b_savefolder_pass, temp_folder=temp_folder, experiment=os.path.dirname(bpass))
 
     time.sleep(3)
     print(f"PIV を {temp_folder} の環境で起動しました (PID: {pid})")
@@ -161,14 +98,17 @@ if __name__ == '__main__':
     savefolder_pass = os.path.abspath(savefolder_pass)
     
     valid_folders = get_folders_with_bmp(apass)
+    registry = InstanceRegistry(REGISTRY_PATH)
     
     if not valid_folders:
         print("BMPファイルのあるフォルダが見つかりませんでした。")
     else:
         for bpass in valid_folders:
-            name, final_num = extract_common_name_and_final_num(bpass)
+            info = bmp_sequence_info(bpass)
             
-            if name and final_num:
+            if info is not None and info["name"] is not None:
+                name = info["name"]
+                print_bmp_report(bpass, info)
                 first_number = input(f"\n【{name}の解析】\n　1枚目番号を入力してください(00でSkip): ").strip()
                 
                 if first_number == "00":
@@ -176,4 +116,7 @@ if __name__ == '__main__':
                     continue  # スキップして次のフォルダへ
 
                 b_savefolder_pass = create_save_folder(savefolder_pass, bpass)
-                launch_piv_instance(bpass, name, final_num, b_savefolder_pass, first_number)
\ No newline at end of file
+                # 欠番をまたぐ組をPIVソフトに渡さないよう、n→n+1 が続く区間ごとに起動する
+                pairs = plan_pairs(int(first_number), info["last"], missing=info["missing"])
+                for first, last in consecutive_runs(pairs):
+                    launch_piv_instance(registry, bpass, name, last + 1, b_savefolder_pass, str(first))
\ No newline at end of file
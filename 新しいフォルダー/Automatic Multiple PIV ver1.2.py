@@ -1,42 +1,24 @@
 import os
-import glob
-import re
 import time
-import subprocess
 import keyboard
 import pyautogui
-import json
 import uuid
+from piv_jobs import PivJob, JobScheduler, standin_command, print_summary, DEFAULT_MAX_CONCURRENCY, STANDIN_COMMAND_ENV
+from piv_registry import InstanceRegistry, REGISTRY_NAME
+from bmp_sequence import get_folders_with_bmp, bmp_sequence_info, print_bmp_report, create_save_folder
+from piv_pairs import plan_pairs, consecutive_runs
 
-RUNNING_INSTANCES_FILE = "running_instances.json"
 TEMP_ROOT_FOLDER = os.path.join(os.environ['LOCALAPPDATA'], "Temp", "PIV_Global")
 
 if not os.path.exists(TEMP_ROOT_FOLDER):
     os.makedirs(TEMP_ROOT_FOLDER, exist_ok=True)
 
-def load_running_instances():
-    """ 現在実行中のPIVインスタンスをロードする """
-    if os.path.exists(RUNNING_INSTANCES_FILE):
-        with open(RUNNING_INSTANCES_FILE, "r") as f:
-            return json.load(f)
-    return {}
-
-def save_running_instances(instances):
-    """ 実行中のPIVインスタンス情報を保存する """
-    with open(RUNNING_INSTANCES_FILE, "w") as f:
-        json.dump(instances, f, indent=4)
-
-def cleanup_finished_instances():
-    """ すでに終了しているPIVインスタンスをリストから削除 """
-    instances = load_running_instances()
-    active_instances = {}
-    
-    for key, info in instances.items():
-        pid = info.get("pid")
-        if pid and is_process_running(pid):
-            active_instances[key] = info
-    
-    save_running_instances(active_instances)
+# 実行中・終了したPIVインスタンスの記録（同時に起動した他のランチャーと共有する）
+REGISTRY_PATH = os.path.join(TEMP_ROOT_FOLDER, REGISTRY_NAME)
+
+def cleanup_finished_instances(registry):
+    """ すでに終了しているPIVインスタンスを終了済みにする """
+    registry.cleanup_finished(is_process_running)
 
 def is_process_running(pid):
     """ 指定したPIDのプロセスが実行中か確認 """
@@ -54,98 +36,65 @@ def get_unique_temp_folder():
             os.makedirs(temp_folder, exist_ok=True)
             return temp_folder
 
-def get_folders_with_bmp(base_path):
-    """ 指定フォルダ内のフォルダを取得し、bmpファイルがあるフォルダのみ返す """
-    folder_paths = [os.path.abspath(f) for f in glob.glob(os.path.join(base_path, '*')) if os.path.isdir(f)]
-    valid_folders = []
-    
-    for folder in folder_paths:
-        bmp_files = glob.glob(os.path.join(folder, '*.bmp'))
-        if bmp_files:
-            valid_folders.append(folder)
-    
-    return valid_folders
+def piv_command(job):
+    """ PIVソフトを起動するコマンド（start /wait でPIVソフトが終了するまで待つ） """
+    user_profile = os.environ['USERPROFILE']
+    shortcut_path = os.path.abspath(os.path.join(user_profile, r'AppData\Roaming\Microsoft\Windows\Start Menu\Programs\PIV\PIV.lnk'))
+    return ['cmd', '/c', 'start', '/wait', '', shortcut_path]
 
-def extract_common_name_and_final_num(folder):
-    """ フォルダ内のbmpファイルから共通名(name)と最終番号(final_num)を取得 """
-    bmp_files = glob.glob(os.path.join(folder, '*.bmp'))
-    if not bmp_files:
-        return None, None
+def piv_environment(job):
+    """ ジョブごとのテンポラリフォルダを TEMP/TMP にした環境変数を作り、競合を防ぐ """
+    cleanup_finished_instances(registry)
+    job.temp_folder = get_unique_temp_folder()
 
-    pattern = re.compile(r'^(.*?)(\d{6})\.bmp$')
-    file_info = []
-    
-    for file in bmp_files:
-        filename = os.path.basename(file)
-        match = pattern.match(filename)
-        if match:
-            base_name, number = match.groups()
-            file_info.append((base_name, int(number)))
-    
-    if not file_info:
-        return None, None
-    
-    file_info.sort(key=lambda x: x[1])
-    final_num = file_info[-1][1]
-    
-    return file_info[0][0], final_num
-
-def create_save_folder(savefolder_pass, bpass):
-    """ Bpassの最終フォルダ名と同じフォルダを savefolder_pass に作成 """
-    folder_name = os.path.basename(bpass)
-    save_path = os.path.join(savefolder_pass, folder_name)
-    os.makedirs(save_path, exist_ok=True)
-    return save_path
-
-def launch_piv_instance(bpass, name, final_num, b_savefolder_pass):
-    """ PIVソフトを起動し、競合を防ぐ """
-    cleanup_finished_instances()
-    temp_folder = get_unique_temp_folder()
-    
     env = os.environ.copy()
-    env["TEMP"] = temp_folder
-    env["TMP"] = temp_folder
-
-    user_profile = os.environ['USERPROFILE']
-    shortcut_path = os.path.abspath(os.path.join(user_profile, r'AppData\Roaming\Microsoft\Windows\Start Menu\Programs\PIV\PIV.lnk'))
-    
-    process = subprocess.Popen(['cmd', '/c', 'start', '', shortcut_path], shell=True, env=env)
-    pid = process.pid
-    
-    instances = load_running_instances()
-    instances[temp_folder] = {"pid": pid, "bpass": bpass, "name": name, "final_num": final_num, "b_savefolder_pass": b_savefolder_pass}
-    save_running_instances(instances)
-    
+    env["TEMP"] = job.temp_folder
+    env["TMP"] = job.temp_folder
+    return env
+
+def register_instance(job):
+    """ 起動したPIVインスタンスを記録する """
+    job.registry_id = registry.add(job.pid, job.bpass, job.name, job.final_num, job.b_savefolder_pass,
+                                   temp_folder=job.temp_folder, experiment=os.path.dirname(job.bpass))
+    print(f"PIV を {job.temp_folder} の環境で起動しました (PID: {job.pid})")
+
+def record_finished(job):
+    """ 終わったPIVインスタンスの終了状態を記録する """
+    if job.registry_id is not None:
+        registry.update_status(job.registry_id, job.status, job.returncode)
+
+def launch_piv_instance(job):
+    """ 起動したPIVソフトに条件を入力してPIVを開始する """
+    register_instance(job)
     time.sleep(3)
-    print(f"PIV を {temp_folder} の環境で起動しました (PID: {pid})")
     
     # TABキー3回
     pyautogui.press('tab', presses=3)
 
     # Bpassを入力
-    print(f"入力するBpass: {bpass}")
-    keyboard.write(bpass)
+    print(f"入力するBpass: {job.bpass}")
+    keyboard.write(job.bpass)
     pyautogui.press('tab', presses=2)
 
     # nameを入力
-    print(f"入力するName: {name}")
-    keyboard.write(name)
+    print(f"入力するName: {job.name}")
+    keyboard.write(job.name)
     pyautogui.press('tab', presses=3)
 
     # first_numberを入力
-    print(f"入力するfirst_number: {first_number}")
-    keyboard.write(first_number)
+    print(f"入力するfirst_number: {job.first_number}")
+    keyboard.write(job.first_number)
     pyautogui.press('tab', presses=1)
 
     # final_num - 1 を入力
-    final_input_num = str(final_num - 1)
+    final_input_num = str(job.final_num - 1)
     print(f"入力するFinalNum: {final_input_num}")
     keyboard.write(final_input_num)
     pyautogui.press('tab', presses=7)
 
     # B_savefolder_passを入力
-    print(f"入力するB_savefolder_pass: {b_savefolder_pass}")
-    keyboard.write(b_savefolder_pass)
+    print(f"入力するB_savefolder_pass: {job.b_savefolder_pass}")
+    keyboard.write(job.b_savefolder_pass)
 
     # ファイル読み込み
     pyautogui.press('tab', presses=3)
@@ -162,19 +111,36 @@ if __name__ == '__main__':
     apass = input("bmpファイルが入ったフォルダが複数入っている親フォルダのパス(Apass)を入力してください: ").strip()
     savefolder_pass = input("保存先のフォルダパス(savefolder_pass)を入力してください: ").strip()
     first_number = input("1枚目番号(first_number)を入力してください:").strip()
+    max_concurrency = int(input(f"同時に実行するPIVの数を入力してください [{DEFAULT_MAX_CONCURRENCY}]: ").strip() or DEFAULT_MAX_CONCURRENCY)
 
     apass = os.path.abspath(apass)
     savefolder_pass = os.path.abspath(savefolder_pass)
     
     valid_folders = get_folders_with_bmp(apass)
+    registry = InstanceRegistry(REGISTRY_PATH)
     
     if not valid_folders:
         print("BMPファイルのあるフォルダが見つかりませんでした。")
     else:
+        # 環境変数 PIV_COMMAND があれば、PIVソフトの代わりにそのコマンドを実行する（テスト用）
+        standin = os.environ.get(STANDIN_COMMAND_ENV)
+        if standin:
+            scheduler = JobScheduler(standin_command(standin), max_concurrency, env=piv_environment, on_start=register_instance, on_finish=record_finished)
+        else:
+            scheduler = JobScheduler(piv_command, max_concurrency, env=piv_environment, on_start=launch_piv_instance, on_finish=record_finished, shell=True)
+
         for bpass in valid_folders:
             bpass = os.path.abspath(bpass)
+            info = bmp_sequence_info(bpass)
+            if info is None or info["name"] is None:
+                continue
+            print_bmp_report(bpass, info)
             b_savefolder_pass = create_save_folder(savefolder_pass, bpass)
-            name, final_num = extract_common_name_and_final_num(bpass)
             
-            if name and final_num:
-                launch_piv_instance(bpass, name, final_num, b_savefolder_pass)
\ No newline at end of file
+            # 欠番をまたぐ組をPIVソフトに渡さないよう、n→n+1 が続く区間ごとに起動する
+            pairs = plan_pairs(int(first_number), info["last"], missing=info["missing"])
+            for first, last in consecutive_runs(pairs):
+                scheduler.submit(PivJob(bpass, info["name"], str(first), last + 1, b_savefolder_pass))
+
+        print_summary(scheduler.run())
+        print(f"この実験の記録: {registry.summary(apass)}")
\ No newline at end of file
@@ -0,0 +1,124 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from bmp_sequence import (get_folders_with_bmp, extract_common_name_and_final_num, create_save_folder, bmp_path,
+                          bmp_sequence_info, print_bmp_report)
+from piv_engine import process_pairs, ensemble_pairs, DEFAULT_WINDOW, DEFAULT_STEP
+from piv_io import save_frame
+from piv_manifest import Manifest
+from piv_pairs import (plan_pairs, frame_schedule, pair_lags, pair_vector_path, ensemble_path, split_pairs,
+                       PAIRING_CONSECUTIVE, PAIRING_STRIDED, PAIRING_AB, PAIRING_SLIDING)
+
+# 1つのワーカーにまとめて渡す画像の組の数
+PAIRS_PER_TASK = 50
+
+# 組の作り方の選択肢
+PAIRING_CHOICES = {"1": PAIRING_CONSECUTIVE, "2": PAIRING_STRIDED, "3": PAIRING_AB, "4": PAIRING_SLIDING}
+
+if __name__ == '__main__':
+    apass = input("bmpファイルが入ったフォルダが複数入っている親フォルダのパス(Apass)を入力してください: ").strip()
+    savefolder_pass = input("保存先のフォルダパス(savefolder_pass)を入力してください: ").strip()
+    first_number = int(input("1枚目番号(first_number)を入力してください:").strip())
+    window_input = input(f"検査窓の大きさ(px)を入力してください（多段処理は 64,32,16 のように入力） [{DEFAULT_WINDOW}]: ").strip()
+    window = tuple(int(w) for w in window_input.split(",")) if window_input else (DEFAULT_WINDOW,)
+    step = int(input(f"ベクトルの間隔(px)を入力してください [{DEFAULT_STEP}]: ").strip() or DEFAULT_STEP)
+    ensemble = (input("処理の種類を選択 (1: 組ごとのベクトルファイル, 2: アンサンブル相関で平均場のみ) [1]: ").strip() or "1") == "2"
+    if ensemble and len(window) > 1:
+        # アンサンブル相関は1段で計算する（多段処理には組ごとの予測値が要るため）
+        window = window[-1:]
+        print(f"アンサンブル相関は最後の窓 {window[0]} px の1段で計算します。")
+    pairing = PAIRING_CHOICES.get(input("組の作り方を選択 (1: 連続 n→n+1, 2: 間隔指定 n→n+s, 3: ダブルフレーム 1→2, 3→4, ..., 4: スライディング n→n+1〜n+k) [1]: ").strip() or "1", PAIRING_CONSECUTIVE)
+    stride = span = 1
+    if pairing == PAIRING_STRIDED:
+        stride = int(input("組の間隔 s を入力してください [2]: ").strip() or "2")
+    elif pairing == PAIRING_SLIDING:
+        span = int(input("組にする最大の間隔 k を入力してください [2]: ").strip() or "2")
+    workers_input = input(f"並列プロセス数を入力してください [{os.cpu_count()}]: ").strip()
+    max_workers = int(workers_input) if workers_input else os.cpu_count()
+
+    apass = os.path.abspath(apass)
+    savefolder_pass = os.path.abspath(savefolder_pass)
+
+    valid_folders = get_folders_with_bmp(apass)
+
+    if not valid_folders:
+        print("BMPファイルのあるフォルダが見つかりませんでした。")
+    else:
+        start_time = time.perf_counter()
+        total_pairs = 0
+        skipped_pairs = 0
+        params = {"window": window, "step": step, "pairing": pairing, "stride": stride, "span": span, "ensemble": ensemble}
+        ensembles = {}
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for bpass in valid_folders:
+                name, final_num = extract_common_name_and_final_num(bpass)
+                if not (name and final_num):
+                    continue
+
+                info = bmp_sequence_info(bpass)
+                print_bmp_report(bpass, info)
+                b_savefolder_pass = create_save_folder(savefolder_pass, bpass)
+                manifest = Manifest(b_savefolder_pass)
+                pairs = plan_pairs(first_number, final_num, pairing, stride, span, info["missing"])
+                lags = pair_lags(pairs)
+                if ensemble:
+                    # 時間間隔ごとに全組の相関面を足し合わせ、平均場を1つ作る
+                    for lag in lags:
+                        lag_pairs = [pair for pair in pairs if pair[1] - pair[0] == lag]
+                        key = f"ensemble:lag{lag}"
+                        inputs = [bmp_path(bpass, name, number) for number in frame_schedule(lag_pairs)[0]]
+                        outputs = [ensemble_path(b_savefolder_pass, name, lag, lags)]
+                        if manifest.is_current(key, inputs, params, outputs):
+                            skipped_pairs += len(lag_pairs)
+                            continue
+                        tasks = split_pairs(lag_pairs, PAIRS_PER_TASK)
+                        ensembles[outputs[0]] = {"correlation": None, "pending": len(tasks)}
+                        for task_pairs in tasks:
+                            future = executor.submit(ensemble_pairs, bpass, name, task_pairs, window[0], step)
+                            futures[future] = (name, None, None, manifest, key, inputs, outputs)
+                    continue
+
+                for task_pairs in split_pairs(pairs, PAIRS_PER_TASK):
+                    # 前回と同じ画像・条件で出力がそろっている区間は処理しない
+                    start, stop = task_pairs[0][0], task_pairs[-1][1]
+                    key = f"piv:{start}-{stop}"
+                    inputs = [bmp_path(bpass, name, number) for number in frame_schedule(task_pairs)[0]]
+                    outputs = [pair_vector_path(b_savefolder_pass, name, pair, lags) for pair in task_pairs]
+                    if manifest.is_current(key, inputs, params, outputs):
+                        skipped_pairs += len(task_pairs)
+                        continue
+                    future = executor.submit(process_pairs, bpass, name, task_pairs, b_savefolder_pass, window, step, lags=lags)
+                    futures[future] = (name, start, stop, manifest, key, inputs, outputs)
+
+            if skipped_pairs:
+                print(f"変更のない {skipped_pairs} 組はスキップします。")
+
+            for future in as_completed(futures):
+                name, start, stop, manifest, key, inputs, outputs = futures[future]
+                if start is None:
+                    # アンサンブル相関: ワーカーごとの部分和をまとめ、全部そろったらピークを求めて保存する
+                    group = ensembles[outputs[0]]
+                    partial = future.result()
+                    total_pairs += partial.count
+                    group["correlation"] = partial if group["correlation"] is None else group["correlation"].merge(partial)
+                    group["pending"] -= 1
+                    if group["pending"]:
+                        continue
+                    os.makedirs(os.path.dirname(outputs[0]), exist_ok=True)
+                    save_frame(outputs[0], group.pop("correlation").frame())
+                    manifest.record(key, inputs, params, outputs)
+                    manifest.save()
+                    print(f"アンサンブル相関 完了: {outputs[0]}")
+                    continue
+
+                total_pairs += future.result()
+                manifest.record(key, inputs, params, outputs)
+                manifest.save()
+                print(f"PIV 完了: {name} {start}〜{stop}")
+
+        elapsed = time.perf_counter() - start_time
+        if total_pairs:
+            print(f"{total_pairs} 組を {elapsed:.1f} 秒で処理しました "
+                  f"({total_pairs / elapsed:.2f} 組/秒, 1コアあたり {total_pairs / elapsed / max_workers:.2f} 組/秒)")
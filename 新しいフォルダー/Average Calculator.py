@@ -2,6 +2,9 @@ import numpy as np
 import glob
 import re
 import os
+from piv_io import save_frame, AVERAGED_TEXT_FORMAT
+from piv_stats import accumulate_frames, save_statistics
+from piv_validate import VectorValidator, MEDIAN_THRESHOLD, MEDIAN_EPSILON
 
 def get_txt_files(directory):
     """
@@ -19,26 +22,10 @@ def extract_pattern(file_name):
         return match.group(1), int(match.group(2))  # (共通部分, 連番部分)
     return None, None
 
-def read_data(file_path):
-    """
-    指定されたファイルのデータを読み込む。
-    左2列は文字データ、それ以降は数値データとして処理する。
-    """
-    left_cols = []
-    numeric_data = []
-    
-    with open(file_path, 'r') as file:
-        for line in file:
-            values = line.split()
-            if len(values) > 2:
-                left_cols.append(values[:2])  # 左2列を保存
-                numeric_data.append([float(v) for v in values[2:]])
-    
-    return left_cols, np.array(numeric_data)
-
-def process_files(directory):
+def process_files(directory, validator=None):
     """
     指定されたディレクトリ内のファイルを処理し、同じパターンのファイルを平均化する。
+    validator を渡すと、マスク（フラグ -1）の点と外れ値を除いて平均する。
     """
     all_files = get_txt_files(directory)
     file_groups = {}
@@ -60,31 +47,35 @@ def process_files(directory):
             print("ファイルが1つしかないためスキップ\n")
             continue
         
-        base_left_cols, base_data = read_data(file_paths[0])
-        num_files = len(file_paths)
-        sum_data = np.zeros_like(base_data)
-        
-        for file_path in file_paths:
-            left_cols, data = read_data(file_path)
-            
-            if data.shape != base_data.shape or left_cols != base_left_cols:
-                print(f"エラー: {file_path} のデータ構造が異なります。処理を中止します。\n")
-                continue
-            
-            sum_data += data  # データを累積
+        # 1フレームずつ平均・分散・レイノルズ応力を更新（格子が最初のファイルと異なるファイルは除く）
+        base_left_cols, stats, skipped = accumulate_frames(file_paths, validator)
+        for file_path in skipped:
+            print(f"エラー: {file_path} のデータ構造が異なります。スキップします。\n")
+        num_files = len(file_paths) - len(skipped)
+        if stats is None:
+            print("読み込めるファイルがないためスキップ\n")
+            continue
         
-        averaged_data = sum_data / num_files
+        averaged_data = stats.averaged()  # 格子点ごとの有効サンプル数で割る
         output_path = os.path.join(directory, f"{prefix}_averaged.txt")
         
-        with open(output_path, 'w') as file:
-            for left, avg_row in zip(base_left_cols, averaged_data):
-                file.write("  ".join(left) + "  " + "  ".join(f"{v:.8e}" for v in avg_row) + "\n")
+        save_frame(output_path, np.column_stack([base_left_cols, averaged_data]), fmt=AVERAGED_TEXT_FORMAT)
+        
+        statistics_path = os.path.join(directory, f"{prefix}_statistics.txt")
+        save_statistics(statistics_path, base_left_cols, stats)
         
         print(f"{num_files} 個のファイルを平均化し、{output_path} に保存しました。\n")
+        print(f"統計量（標準偏差・RMS・レイノルズ応力・有効数）を {statistics_path} に保存しました。\n")
 
 if __name__ == "__main__":
     directory = input("処理するフォルダのパスを入力してください: ").strip()
     if os.path.isdir(directory):
-        process_files(directory)
+        validator = None
+        if (input("外れ値を検出して平均から除きますか (1: しない, 2: する) [1]: ").strip() or "1") == "2":
+            threshold = float(input(f"正規化メディアン検定のしきい値を入力 [{MEDIAN_THRESHOLD}]: ").strip() or MEDIAN_THRESHOLD)
+            epsilon = float(input(f"正規化メディアン検定の下限値 ε を入力 [{MEDIAN_EPSILON}]: ").strip() or MEDIAN_EPSILON)
+            speed_input = input("速さの上限を入力（空欄で制限なし）: ").strip()
+            validator = VectorValidator(threshold, epsilon, speed_max=float(speed_input) if speed_input else None)
+        process_files(directory, validator)
     else:
         print("エラー: 指定されたフォルダが見つかりません。\n")
@@ -2,6 +2,14 @@ import numpy as np
 import glob
 import re
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from piv_io import load_frame, save_frame, AVERAGED_TEXT_FORMAT
+from piv_stats import accumulate_frames, save_statistics
+from piv_manifest import Manifest
+from piv_validate import VectorValidator, MEDIAN_THRESHOLD, MEDIAN_EPSILON
+
+# 1つのワーカーにまとめて渡すフレーム数（大きなフォルダはこの単位で分割して並列化）
+FRAMES_PER_TASK = 500
 
 def get_folders(directory):
     """
@@ -24,67 +32,167 @@ def extract_pattern(file_name):
         return match.group(1), int(match.group(2))
     return None, None
 
-def read_data(file_path):
+def group_files(input_dir):
+    """
+    フォルダ内の .txt を共通部分ごとにまとめ、連番順に並べる。
+    ファイルが1つしかないグループは除く。
+    """
+    file_groups = {}
+    
+    for file in get_txt_files(input_dir):
+        prefix, number = extract_pattern(file)
+        if prefix:
+            if prefix not in file_groups:
+                file_groups[prefix] = []
+            file_groups[prefix].append((number, file))
+    
+    return {prefix: [f[1] for f in sorted(files)] for prefix, files in file_groups.items() if len(files) >= 2}
+
+def group_outputs(output_dir, prefix):
+    """
+    グループの出力ファイル（平均値と統計量）のパス。
+    """
+    return [os.path.join(output_dir, f"{prefix}_averaged.txt"), os.path.join(output_dir, f"{prefix}_statistics.txt")]
+
+def group_key(input_dir, prefix):
+    """
+    処理記録（マニフェスト）でグループを区別するキー。
+    """
+    return f"average:{os.path.abspath(input_dir)}:{prefix}"
+
+def group_params(validator):
+    """
+    処理記録に残す平均化の条件（外れ値の検証条件）。
+    """
+    return {} if validator is None else {"validation": validator.params()}
+
+def stale_groups(input_dir, output_dir, manifest, validator=None):
+    """
+    group_files のうち、前回の平均化から入力ファイルか条件が変わったグループ（または未処理のグループ）だけを返す。
+    """
+    groups = {}
+    
+    for prefix, file_paths in group_files(input_dir).items():
+        if manifest.is_current(group_key(input_dir, prefix), file_paths, group_params(validator), group_outputs(output_dir, prefix)):
+            print(f"変更なし: {os.path.basename(input_dir)} ({prefix}...) をスキップします。")
+            continue
+        groups[prefix] = file_paths
+    
+    return groups
+
+def record_group(manifest, input_dir, prefix, file_paths, output_dir, validator=None):
+    """
+    平均化を終えたグループを記録する。
+    """
+    manifest.record(group_key(input_dir, prefix), file_paths, group_params(validator), group_outputs(output_dir, prefix))
+    manifest.save()
+
+def reference_grid(file_paths):
+    """
+    グループの基準の格子（最初に読めたファイルの x, y）。逐次処理の accumulate_frames と同じ基準になる。
+    読めるファイルがなければ None。
+    """
+    for file_path in file_paths:
+        try:
+            return load_frame(file_path)[:, :2].copy()
+        except (ValueError, OSError):
+            continue
+    return None
+
+def split_chunks(file_paths):
+    """
+    グループを FRAMES_PER_TASK ファイルずつのチャンクに分ける（逐次処理でも並列処理と同じ単位で集計して結果をそろえる）。
+    """
+    return [file_paths[i:i + FRAMES_PER_TASK] for i in range(0, len(file_paths), FRAMES_PER_TASK)]
+
+def merge_partials(partials):
     """
-    指定されたファイルのデータを読み込む。
-    左2列は文字データ、それ以降は数値データとして処理する。
+    分割して求めた部分統計をチャンク順に統合する（順序が固定なので結果は毎回同じ）。
+    チャンクはすべて同じ基準の格子で集計しているので、格子の異なるファイルは各チャンクでスキップ済み。
     """
-    left_cols = []
-    numeric_data = []
+    grid_xy = stats = None
+    skipped = []
     
-    with open(file_path, 'r') as file:
-        for line in file:
-            values = line.split()
-            if len(values) > 2:
-                left_cols.append(values[:2])
-                numeric_data.append([float(v) for v in values[2:]])
+    for chunk_grid, chunk_stats, chunk_skipped in partials:
+        skipped.extend(chunk_skipped)
+        if chunk_stats is None:
+            continue  # 読めるファイルが1つもないチャンク
+        if stats is None:
+            grid_xy, stats = chunk_grid, chunk_stats
+        else:
+            stats.merge(chunk_stats)
     
-    return left_cols, np.array(numeric_data)
+    return grid_xy, stats, skipped
 
-def process_files(input_dir, output_dir):
+def save_group(output_dir, prefix, grid_xy, stats, skipped):
+    """
+    平均値と統計量を output_dir に保存する。
+    """
+    for file_path in skipped:
+        print(f"エラー: {file_path} のデータ構造が異なります。")
+    if stats is None:
+        print(f"{prefix}: 読み込めるファイルがないため保存しません。")
+        return
+    
+    averaged_data = stats.averaged()  # 格子点ごとの有効サンプル数で割る
+    output_path, statistics_path = group_outputs(output_dir, prefix)
+    
+    save_frame(output_path, np.column_stack([grid_xy, averaged_data]), fmt=AVERAGED_TEXT_FORMAT)
+    
+    save_statistics(statistics_path, grid_xy, stats)
+    
+    print(f"{stats.num_frames} 個のファイルを平均化し、{output_path} に保存しました。")
+
+def process_files(input_dir, output_dir, manifest, validator=None):
     """
     指定されたディレクトリ内のファイルを処理し、
     同じパターンのファイルを平均化してoutput_dirに保存する。
+    入力が前回から変わっていないグループは処理しない。
+    validator を渡すと、マスクされた点と外れ値を除いて平均する。
+    """
+    for prefix, file_paths in stale_groups(input_dir, output_dir, manifest, validator).items():
+        grid_xy = reference_grid(file_paths)
+        partials = [accumulate_frames(chunk, validator, grid_xy) for chunk in split_chunks(file_paths)]
+        grid_xy, stats, skipped = merge_partials(partials)
+        save_group(output_dir, prefix, grid_xy, stats, skipped)
+        record_group(manifest, input_dir, prefix, file_paths, output_dir, validator)
+
+def process_folders_parallel(Bpass_list, output_dir, max_workers, manifest, validator=None):
+    """
+    複数フォルダ（と大きなフォルダ内のフレーム群）をプロセスプールに分散して平均化する。
+    各グループのチャンクがすべて揃った時点で統合して保存する。
+    入力が前回から変わっていないグループは処理しない。
     """
-    all_files = get_txt_files(input_dir)
-    if not all_files:
-        return  # ファイルがない場合はスキップ
+    groups = {}
+    chunks = {}
+    for Bpass in Bpass_list:
+        for prefix, file_paths in stale_groups(Bpass, output_dir, manifest, validator).items():
+            groups[(Bpass, prefix)] = file_paths
+            chunks[(Bpass, prefix)] = split_chunks(file_paths)
     
-    file_groups = {}
+    total = sum(len(c) for c in chunks.values())
+    if total == 0:
+        return
     
-    for file in all_files:
-        prefix, number = extract_pattern(file)
-        if prefix:
-            if prefix not in file_groups:
-                file_groups[prefix] = []
-            file_groups[prefix].append((number, file))
+    partials = {key: [None] * len(c) for key, c in chunks.items()}
+    remaining = {key: len(c) for key, c in chunks.items()}
     
-    for prefix, files in file_groups.items():
-        files.sort()
-        file_paths = [f[1] for f in files]
-        
-        if len(file_paths) < 2:
-            continue  # ファイルが1つしかない場合はスキップ
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for key, key_chunks in chunks.items():
+            grid_xy = reference_grid(groups[key])  # チャンクの先頭のファイルが壊れていてもチャンク全体を落とさない
+            for index, chunk in enumerate(key_chunks):
+                futures[executor.submit(accumulate_frames, chunk, validator, grid_xy)] = (key, index)
         
-        base_left_cols, base_data = read_data(file_paths[0])
-        num_files = len(file_paths)
-        sum_data = np.zeros_like(base_data)
-        
-        for file_path in file_paths:
-            left_cols, data = read_data(file_path)
-            if data.shape != base_data.shape or left_cols != base_left_cols:
-                print(f"エラー: {file_path} のデータ構造が異なります。")
-                continue
-            sum_data += data
-        
-        averaged_data = sum_data / num_files
-        output_path = os.path.join(output_dir, f"{prefix}_averaged.txt")
-        
-        with open(output_path, 'w') as file:
-            for left, avg_row in zip(base_left_cols, averaged_data):
-                file.write("  ".join(left) + "  " + "  ".join(f"{v:.8e}" for v in avg_row) + "\n")
-        
-        print(f"{num_files} 個のファイルを平均化し、{output_path} に保存しました。")
+        for done, future in enumerate(as_completed(futures), start=1):
+            key, index = futures[future]
+            partials[key][index] = future.result()
+            remaining[key] -= 1
+            print(f"[{done}/{total}] {os.path.basename(key[0])} ({key[1]}...) チャンク {index + 1}/{len(chunks[key])} 完了")
+            
+            if remaining[key] == 0:
+                save_group(output_dir, key[1], *merge_partials(partials.pop(key)))
+                record_group(manifest, key[0], key[1], groups[key], output_dir, validator)
 
 if __name__ == "__main__":
     Apass = input("処理する親フォルダ(Apass)のパスを入力してください: ").strip()
@@ -98,11 +206,25 @@ if __name__ == "__main__":
         print("エラー: 指定された保存先フォルダが見つかりません。")
         exit()
     
+    workers_input = input(f"並列プロセス数を入力してください (1で逐次処理) [{os.cpu_count()}]: ").strip()
+    max_workers = int(workers_input) if workers_input else os.cpu_count()
+    
+    # マスク（フラグ -1）の点と外れ値を平均から除く
+    validator = None
+    if (input("外れ値を検出して平均から除きますか (1: しない, 2: する) [1]: ").strip() or "1") == "2":
+        threshold = float(input(f"正規化メディアン検定のしきい値を入力 [{MEDIAN_THRESHOLD}]: ").strip() or MEDIAN_THRESHOLD)
+        epsilon = float(input(f"正規化メディアン検定の下限値 ε を入力 [{MEDIAN_EPSILON}]: ").strip() or MEDIAN_EPSILON)
+        speed_input = input("速さの上限を入力（空欄で制限なし）: ").strip()
+        validator = VectorValidator(threshold, epsilon, speed_max=float(speed_input) if speed_input else None)
+    
     Bpass_list = get_folders(Apass)
-    Bpass_list = [b for b in Bpass_list if get_txt_files(b)]  # txtファイルがあるフォルダのみ処理
+    manifest = Manifest(savefolder_pass)
     
-    for Bpass in Bpass_list:
-        print(f"処理中: {Bpass}")
-        process_files(Bpass, savefolder_pass)
+    if max_workers > 1:
+        process_folders_parallel(Bpass_list, savefolder_pass, max_workers, manifest, validator)
+    else:
+        for Bpass in Bpass_list:
+            print(f"処理中: {Bpass}")
+            process_files(Bpass, savefolder_pass, manifest, validator)
     
     print("処理完了。")
\ No newline at end of file
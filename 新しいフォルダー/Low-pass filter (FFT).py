@@ -1,16 +1,26 @@
 import os
 import numpy as np
+from piv_io import try_load_frame, save_frame, save_frames, frame_output_path
+from piv_cube import load_cube, cube_numbers, list_frame_files
+from piv_filter import lowpass_cube, lowpass_folder_chunked, iir_lowpass_folder, DEFAULT_IIR_ORDER
+from piv_manifest import Manifest
+from piv_sequence import sequence_index, print_sequence_report, GAP_SPLIT, GAP_INTERPOLATE
+from piv_validate import VectorValidator, print_validation_summary, MEDIAN_THRESHOLD, MEDIAN_EPSILON
 from scipy.fftpack import fft, ifft
-from fractions import Fraction
 
-def load_data_from_folder(folder_path):
-    data_files = [f for f in os.listdir(folder_path) if f.endswith(".txt")]
+# 出力ファイルの書式化・保存に使うプロセス数
+WRITE_WORKERS = os.cpu_count()
+
+def load_data_from_folder(folder_path, data_files=None):
+    if data_files is None:
+        data_files = [f for f in os.listdir(folder_path) if f.endswith(".txt")]
     all_data = {}
     
     for file in sorted(data_files):
         file_path = os.path.join(folder_path, file)
-        data = np.loadtxt(file_path)
-        all_data[file] = data
+        data = try_load_frame(file_path)  # 読めないファイルは名前を表示して飛ばす
+        if data is not None:
+            all_data[file] = data
     
     return all_data
 
@@ -32,6 +42,64 @@ def extract_common_prefix(filenames):
     prefix = os.path.commonprefix(filenames)
     return prefix.rstrip("_-. ")
 
+def lowpass_in_frame(folder_path, output_folder_path, time_interval, cutoff_freq, binary=False, validator=None, data_files=None):
+    """ 従来の処理: フレームごとに速さ列を FFT する（空間方向のフィルタ。テキストのフレームだけを扱う） """
+    all_data = load_data_from_folder(folder_path, data_files)
+    
+    for file, data in all_data.items():
+        if data.shape[1] < 5:
+            print(f"ファイル {file} のデータ形式が不正です。")
+            continue
+        
+        if validator is not None:
+            data = validator.frame(data)[0]  # 外れ値を近傍から補間してからフィルタする
+        
+        velocity_data = data[:, 4]  # 速さデータを取得
+        freq, fft_values = perform_fft(velocity_data, time_interval)
+        filtered_fft = apply_lowpass_filter(freq, fft_values, cutoff_freq)
+        processed_velocity = np.real(ifft(filtered_fft))
+        
+        data[:, 4] = processed_velocity  # 速さ部分を更新
+        output_file_path = os.path.join(output_folder_path, f"{time_interval:.5f}sec_lp{cutoff_freq:.2f}Hz_{file}")
+        print(f"保存完了: {save_frame(output_file_path, data, binary=binary)}")
+
+def lowpass_in_time(folder_path, output_folder_path, time_interval, cutoff_freq, binary=False, data_files=None, numbers=None, gaps=GAP_SPLIT, validator=None):
+    """ 全格子点の u, v, 速さを時間方向に一括で FFT ローパスし、フレームごとに書き出す（欠番は gaps の方法で扱う） """
+    if data_files is None:
+        data_files = list_frame_files(folder_path)
+    cube = load_cube(folder_path, data_files)
+    if cube is None:
+        print("読み込めるファイルがありません。")
+        return
+    numbers = cube_numbers(cube, data_files, numbers)  # 読めずに飛ばしたフレームは欠番として扱う
+    if validator is not None:
+        # 外れ値を全フレームまとめて検出し、近傍から補間してからフィルタする
+        valid, replaced = validator.cube(cube)
+        print_validation_summary(valid, os.path.basename(os.path.normpath(folder_path)), replaced)
+    lowpass_cube(cube, time_interval, cutoff_freq, numbers, gaps)
+    
+    output_paths = [os.path.join(output_folder_path, f"{time_interval:.5f}sec_lp{cutoff_freq:.2f}Hz_{file}") for file in cube.file_names]
+    frames = (cube.frame(t) for t in range(len(cube.file_names)))
+    save_frames(output_paths, frames, binary=binary, workers=WRITE_WORKERS)
+
+def lowpass_in_time_chunked(folder_path, output_folder_path, time_interval, cutoff_freq, memory_budget_mb, binary=False, data_files=None, numbers=None, gaps=GAP_SPLIT, validator=None):
+    """ 時間方向ローパスを空間タイルごとに分割して行う（全フレームがメモリに載らない長い計測向け） """
+    if data_files is None:
+        data_files = list_frame_files(folder_path)
+    output_paths = [os.path.join(output_folder_path, f"{time_interval:.5f}sec_lp{cutoff_freq:.2f}Hz_{file}") for file in data_files]
+    lowpass_folder_chunked(folder_path, data_files, output_paths, time_interval, cutoff_freq,
+                           memory_budget_mb * 1024 ** 2, scratch_dir=output_folder_path,
+                           binary=binary, workers=WRITE_WORKERS, numbers=numbers, gaps=gaps, validator=validator)
+
+def lowpass_in_time_iir(folder_path, output_folder_path, time_interval, cutoff_freq, order, zero_phase, binary=False, data_files=None, numbers=None, gaps=GAP_SPLIT, validator=None):
+    """ Butterworth ローパスをフレームの順に逐次かける（メモリはフレーム数によらず一定。zero_phase で前後両方向） """
+    if data_files is None:
+        data_files = list_frame_files(folder_path)
+    output_paths = [os.path.join(output_folder_path, f"{time_interval:.5f}sec_lp{cutoff_freq:.2f}Hz_{file}") for file in data_files]
+    iir_lowpass_folder(folder_path, data_files, output_paths, time_interval, cutoff_freq, order, zero_phase,
+                       scratch_dir=output_folder_path, binary=binary, workers=WRITE_WORKERS,
+                       numbers=numbers, gaps=gaps, validator=validator)
+
 def main():
     folder_path = input("フォルダのパスを入力: ")
     save_path = input("処理後のファイルを保存するフォルダのパスを入力: ")
@@ -44,32 +112,72 @@ def main():
         return
     
     cutoff_freq = float(input("ローパスフィルタのカットオフ周波数(Hz)を入力: "))
+    mode = input("フィルタ方向を選択 (1: 時間方向[全格子点], 2: フレーム内[従来], 3: 時間方向[省メモリ分割処理], 4: 時間方向[Butterworth 逐次処理]) [1]: ").strip() or "1"
+    if mode == "3":
+        memory_budget_mb = float(input("使用メモリの上限(MB)を入力 [1024]: ").strip() or "1024")
+    order = DEFAULT_IIR_ORDER
+    zero_phase = False
+    if mode == "4":
+        order = int(input(f"Butterworth フィルタの次数を入力 [{DEFAULT_IIR_ORDER}]: ").strip() or DEFAULT_IIR_ORDER)
+        zero_phase = (input("位相を選択 (1: 因果的[1パス・位相遅れあり], 2: ゼロ位相[前後2パス]) [1]: ").strip() or "1") == "2"
+    binary = input("出力形式を選択 (1: テキスト, 2: バイナリ(.npy)) [1]: ").strip() == "2"
+    
+    # 外れ値は近傍から補間してからフィルタする
+    validator = None
+    if (input("外れ値を検出して補間しますか (1: しない, 2: する) [1]: ").strip() or "1") == "2":
+        threshold = float(input(f"正規化メディアン検定のしきい値を入力 [{MEDIAN_THRESHOLD}]: ").strip() or MEDIAN_THRESHOLD)
+        epsilon = float(input(f"正規化メディアン検定の下限値 ε を入力 [{MEDIAN_EPSILON}]: ").strip() or MEDIAN_EPSILON)
+        speed_input = input("速さの上限を入力（空欄で制限なし）: ").strip()
+        validator = VectorValidator(threshold, epsilon, speed_max=float(speed_input) if speed_input else None)
     
-    all_data = load_data_from_folder(folder_path)
+    data_files = list_frame_files(folder_path)
+    if mode == "2":
+        # 従来の処理はテキストのフレームだけを読み書きする（.npy を入力・出力の記録に含めない）
+        data_files = [file for file in data_files if file.endswith(".txt")]
     
-    if not all_data:
+    if not data_files:
         print("指定したフォルダには処理可能なファイルがありません。")
         return
     
-    common_prefix = extract_common_prefix(list(all_data.keys()))
+    # 番号の抜け・重複を確認する（重複した番号は1つだけ使う）
+    numbers = None
+    gaps = GAP_SPLIT
+    index = sequence_index(data_files)
+    if index["numbers"] and mode != "2":
+        print_sequence_report(index, os.path.basename(os.path.normpath(folder_path)))
+        data_files = index["files"]
+        numbers = index["numbers"]
+        if index["missing"]:
+            gap_mode = input("欠番の扱いを選択 (1: 連続した区間ごとにフィルタ, 2: 前後のフレームから線形補間) [1]: ").strip() or "1"
+            gaps = GAP_INTERPOLATE if gap_mode == "2" else GAP_SPLIT
+    
+    common_prefix = extract_common_prefix(data_files)
     output_folder_name = f"{time_interval:.5f}sec_lp{cutoff_freq:.2f}Hz_{common_prefix}"
     output_folder_path = os.path.join(save_path, output_folder_name)
     os.makedirs(output_folder_path, exist_ok=True)
     
-    for file, data in all_data.items():
-        if data.shape[1] < 5:
-            print(f"ファイル {file} のデータ形式が不正です。")
-            continue
-        
-        velocity_data = data[:, 4]  # 速さデータを取得
-        freq, fft_values = perform_fft(velocity_data, time_interval)
-        filtered_fft = apply_lowpass_filter(freq, fft_values, cutoff_freq)
-        processed_velocity = np.real(ifft(filtered_fft))
-        
-        data[:, 4] = processed_velocity  # 速さ部分を更新
-        output_file_path = os.path.join(output_folder_path, f"{time_interval:.5f}sec_lp{cutoff_freq:.2f}Hz_{file}")
-        np.savetxt(output_file_path, data, fmt='%g')
-        print(f"保存完了: {output_file_path}")
+    # 入力ファイルと条件が前回と同じで、出力もそろっていれば処理しない
+    manifest = Manifest(output_folder_path)
+    input_paths = [os.path.join(folder_path, file) for file in data_files]
+    output_paths = [frame_output_path(os.path.join(output_folder_path, f"{time_interval:.5f}sec_lp{cutoff_freq:.2f}Hz_{file}"), binary) for file in data_files]
+    params = {"time_interval": time_interval, "cutoff_freq": cutoff_freq, "mode": mode, "binary": binary, "gaps": gaps,
+              "order": order if mode == "4" else None, "zero_phase": zero_phase,
+              "validation": validator.params() if validator else None}
+    if manifest.is_current("lowpass", input_paths, params, output_paths):
+        print(f"入力と条件が前回と同じため処理をスキップします: {output_folder_path}")
+        return
+    
+    if mode == "2":
+        lowpass_in_frame(folder_path, output_folder_path, time_interval, cutoff_freq, binary, validator, data_files)
+    elif mode == "4":
+        lowpass_in_time_iir(folder_path, output_folder_path, time_interval, cutoff_freq, order, zero_phase, binary, data_files, numbers, gaps, validator)
+    elif mode == "3":
+        lowpass_in_time_chunked(folder_path, output_folder_path, time_interval, cutoff_freq, memory_budget_mb, binary, data_files, numbers, gaps, validator)
+    else:
+        lowpass_in_time(folder_path, output_folder_path, time_interval, cutoff_freq, binary, data_files, numbers, gaps, validator)
+    
+    manifest.record("lowpass", input_paths, params, output_paths)
+    manifest.save()
 
 if __name__ == "__main__":
     main()
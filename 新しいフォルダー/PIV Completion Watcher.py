@@ -0,0 +1,71 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from bmp_sequence import get_folders_with_bmp, extract_common_name_and_final_num, create_save_folder, bmp_sequence_info, print_bmp_report
+from piv_watch import CompletionWatcher, postprocess_folder, postprocess_outputs, DEFAULT_STABLE_SECONDS
+from piv_manifest import Manifest, POSTPROCESS_MANIFEST_NAME
+
+if __name__ == '__main__':
+    apass = input("bmpファイルが入ったフォルダが複数入っている親フォルダのパス(Apass)を入力してください: ").strip()
+    savefolder_pass = input("PIVの保存先のフォルダパス(savefolder_pass)を入力してください: ").strip()
+    first_number = int(input("1枚目番号(first_number)を入力してください:").strip())
+    average_dir = input("平均化した結果の保存先フォルダ（空欄で平均化しない）: ").strip()
+    lowpass_dir = input("ローパスした結果の保存先フォルダ（空欄でローパスしない）: ").strip()
+    time_interval = cutoff_freq = None
+    if lowpass_dir:
+        time_interval = float(eval(input("データの時間間隔（秒）を入力 (例: 1/60 または 0.0166): ")))
+        cutoff_freq = float(input("ローパスフィルタのカットオフ周波数(Hz)を入力: "))
+    stable_seconds = float(input(f"ファイルが増えなくなってから完了とみなすまでの時間(秒) [{DEFAULT_STABLE_SECONDS:g}]: ").strip() or DEFAULT_STABLE_SECONDS)
+    idle_input = input("どのフォルダも変化しないまま監視を打ち切るまでの時間(秒)（空欄で打ち切らない）: ").strip()
+    idle_timeout = float(idle_input) if idle_input else None
+    workers_input = input(f"後処理の並列プロセス数を入力してください [{os.cpu_count()}]: ").strip()
+    max_workers = int(workers_input) if workers_input else os.cpu_count()
+
+    apass = os.path.abspath(apass)
+    savefolder_pass = os.path.abspath(savefolder_pass)
+    for folder in (average_dir, lowpass_dir):
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    watcher = CompletionWatcher(stable_seconds=stable_seconds)
+    for bpass in get_folders_with_bmp(apass):
+        name, final_num = extract_common_name_and_final_num(bpass)
+        if name and final_num:
+            info = bmp_sequence_info(bpass)
+            print_bmp_report(bpass, info)
+            watcher.watch(create_save_folder(savefolder_pass, bpass), name, first_number, final_num, info["missing"])
+
+    if not watcher.watches:
+        print("BMPファイルのあるフォルダが見つかりませんでした。")
+    else:
+        print(f"{len(watcher.watches)} フォルダを監視します。")
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            params = {"average_dir": average_dir, "lowpass_dir": lowpass_dir, "time_interval": time_interval, "cutoff_freq": cutoff_freq}
+
+            def queue_postprocess(folder_watch):
+                # 完了したフォルダはすぐに後処理に回し、監視は続ける。前回と入力・条件が同じなら何もしない
+                print(f"PIV 完了を検出: {folder_watch.folder} ({folder_watch.found} ファイル)")
+                manifest = Manifest(folder_watch.folder, POSTPROCESS_MANIFEST_NAME)
+                outputs = postprocess_outputs(folder_watch.file_paths, folder_watch.name, average_dir, lowpass_dir, time_interval, cutoff_freq)
+                if manifest.is_current("postprocess", folder_watch.file_paths, params, outputs):
+                    print(f"変更なし: {folder_watch.name} の後処理をスキップします。")
+                    return
+                future = executor.submit(postprocess_folder, folder_watch.file_paths, folder_watch.name,
+                                         average_dir, lowpass_dir, time_interval, cutoff_freq)
+                future.add_done_callback(lambda future: record_postprocess(future, folder_watch, manifest, outputs))
+
+            def record_postprocess(future, folder_watch, manifest, outputs):
+                # 後処理が終わったフォルダはその場で記録する（途中で Ctrl+C しても終わった分は次回スキップされる）
+                if future.cancelled():
+                    return
+                error = future.exception()
+                if error is not None:
+                    print(f"後処理に失敗しました: {folder_watch.folder} ({error})")
+                    return
+                print(f"後処理完了: {future.result()}")
+                manifest.record("postprocess", folder_watch.file_paths, params, outputs)
+                manifest.save()
+
+            for folder_watch in watcher.run(queue_postprocess, idle_timeout=idle_timeout):
+                print(f"監視を打ち切りました（未完了）: {folder_watch.folder} ({folder_watch.found} / {len(folder_watch.file_paths)} ファイル)")
+
+        print("処理完了。")
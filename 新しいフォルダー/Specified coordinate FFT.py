@@ -1,8 +1,14 @@
 import os
+import time
 import numpy as np
+from piv_cube import load_point_series, load_cube, cube_numbers, list_frame_files, build_grid_index, infer_grid, COL_SPEED
+from piv_io import load_frame, load_rows, format_rows
+from piv_spectrum import (welch_psd_gaps, spectral_maps, forcing_frequency_from_name, psd_to_amplitude,
+                          save_spectral_cube, save_spectral_maps, StreamingWelch)
+from piv_watch import FrameFollower, DEFAULT_POLL_INTERVAL
+from piv_sequence import sequence_index, print_sequence_report, has_gaps, fill_gaps, GAP_SPLIT, GAP_INTERPOLATE
 import matplotlib.pyplot as plt
 from scipy.fftpack import fft
-from fractions import Fraction
 import matplotlib
 
 # 日本語フォント設定
@@ -10,32 +16,224 @@ matplotlib.rcParams['font.family'] = 'MS Gothic'  # Windows向け（MS Gothic）
 # matplotlib.rcParams['font.family'] = 'TakaoGothic'  # Linux向け（TakaoGothic）
 # matplotlib.rcParams['font.family'] = 'IPAexGothic'  # Mac向け（IPAexGothic）
 
-def load_data_from_folder(folder_path, target_x, target_y):
-    data_files = [f for f in os.listdir(folder_path) if f.endswith(".txt")]
-    velocity_data = []
-    
-    for file in sorted(data_files):
-        file_path = os.path.join(folder_path, file)
-        data = np.loadtxt(file_path)
-        
-        # X, Y の位置が一致するデータを抽出
-        matching_rows = data[(data[:, 0] == target_x) & (data[:, 1] == target_y)]
-        if len(matching_rows) > 0:
-            velocity_data.append(matching_rows[0, 4])  # 速さの列を取得
-    
-    return np.array(velocity_data)
+def parse_points(text):
+    """ "24,8; 32,16" の形式の入力を [(24.0, 8.0), (32.0, 16.0)] にする """
+    points = []
+    for item in text.split(";"):
+        if item.strip():
+            x, y = item.replace(" ", "").split(",")
+            points.append((float(x), float(y)))
+    return points
+
+def frame_sequence(folder_path):
+    """ フォルダのフレームを番号順に並べ、欠番・重複を表示する。(ファイル名, 番号) を返す """
+    file_names = list_frame_files(folder_path)
+    index = sequence_index(file_names)
+    if not index["numbers"]:
+        return file_names, []  # 連番の形式でなければ名前順のまま使う
+    print_sequence_report(index, os.path.basename(os.path.normpath(folder_path)))
+    return index["files"], index["numbers"]
+
+def load_data_from_folder(folder_path, points):
+    # 座標 → 行番号の索引をフォルダごとに1回作り、各ファイルからは該当行だけを読む
+    file_names, numbers = frame_sequence(folder_path)
+    velocity_data, found, missing = load_point_series(folder_path, points, column=4, file_names=file_names)  # 速さの列を取得
+    if has_gaps(numbers):
+        # FFT は等間隔のデータが前提なので、欠番は前後のフレームから線形補間する
+        print("欠番を前後のフレームから線形補間して FFT します。")
+        velocity_data = fill_gaps(velocity_data, numbers)[0]
+    return velocity_data, found, missing
 
 def perform_fft(velocity_data, time_interval):
     N = len(velocity_data)
     T = time_interval  # データ間隔（秒）
     freq = np.fft.fftfreq(N, T)
-    fft_values = fft(velocity_data)
+    fft_values = fft(velocity_data, axis=0)
     return freq[:N // 2], np.abs(fft_values)[:N // 2]
 
+def field_psd_map(folder_path, time_interval):
+    """ 全格子点の Welch PSD を一括で求め、スペクトルキューブと代表値マップを保存・表示する """
+    save_path = input("結果を保存するフォルダのパスを入力: ")
+    nperseg = int(input("Welch のセグメント長（点数）を入力 [256]: ").strip() or "256")
+    band_input = input("エネルギーを求める帯域 下限,上限 (Hz) を入力 (例: 4,6): ")
+    band = tuple(float(v) for v in band_input.replace(" ", "").split(","))
+    
+    folder_name = os.path.basename(os.path.normpath(folder_path))
+    default_forcing = forcing_frequency_from_name(folder_name)
+    forcing_input = input(f"加振周波数(Hz)を入力 [{default_forcing}]: ").strip()
+    forcing_freq = float(forcing_input) if forcing_input else default_forcing
+    
+    file_names, numbers = frame_sequence(folder_path)
+    gaps = GAP_SPLIT
+    if has_gaps(numbers):
+        gap_mode = input("欠番の扱いを選択 (1: 連続した区間ごとに求めて平均, 2: 前後のフレームから線形補間) [1]: ").strip() or "1"
+        gaps = GAP_INTERPOLATE if gap_mode == "2" else GAP_SPLIT
+    
+    cube = load_cube(folder_path, file_names)
+    if cube is None:
+        print("指定したフォルダには処理可能なファイルがありません。")
+        return
+    numbers = cube_numbers(cube, file_names, numbers)  # 読めずに飛ばしたフレームは欠番として扱う
+    
+    freq, psd, nperseg = welch_psd_gaps(cube.speed, time_interval, nperseg, numbers, gaps)  # 速さの全格子点を一括処理
+    dominant, band_energy, forcing_amplitude = spectral_maps(freq, psd, time_interval, nperseg, band, forcing_freq)
+    
+    os.makedirs(save_path, exist_ok=True)
+    cube_path = os.path.join(save_path, f"{folder_name}_psd_cube.npz")
+    maps_path = os.path.join(save_path, f"{folder_name}_psd_maps.txt")
+    save_spectral_cube(cube_path, freq, psd, cube.x, cube.y)
+    save_spectral_maps(maps_path, cube.x, cube.y, dominant, band_energy, forcing_amplitude)
+    print(f"保存完了: {cube_path}")
+    print(f"保存完了: {maps_path}")
+    
+    extent = (cube.x[0], cube.x[-1], cube.y[-1], cube.y[0])
+    fig, axes = plt.subplots(1, 3, figsize=(18, 6))
+    for ax, values, title in zip(axes, (dominant, band_energy, forcing_amplitude),
+                                 ("卓越周波数 (Hz)", f"帯域エネルギー {band[0]:g}-{band[1]:g} Hz", f"加振周波数 {forcing_freq} Hz の振幅")):
+        image = ax.imshow(values, extent=extent)
+        ax.set_title(title, fontname='MS Gothic')
+        fig.colorbar(image, ax=ax)
+    plt.show()
+
+def write_atomically(output_path, write):
+    """ 一時ファイルに書いてから置き換える（書きかけのスナップショットを他のプログラムが読まないように） """
+    root, ext = os.path.splitext(output_path)
+    temp_path = f"{root}.tmp{ext}"
+    write(temp_path)
+    os.replace(temp_path, output_path)
+
+def save_point_spectra(output_path, freq, psd, points):
+    """ 指定座標ごとの PSD を 周波数 + 座標ごとの列 で書き出す """
+    with open(output_path, "w") as file:
+        file.write("# freq  " + "  ".join(f"({x:g},{y:g})" for x, y in points) + "\n")
+        file.write(format_rows(np.column_stack([freq, psd]), "  ".join(["%g"] + ["%.8e"] * len(points))))
+
+def live_spectrum_monitor(folder_path, time_interval):
+    """
+    PIV や計測の途中で増えていくフォルダを追跡し、Welch 平均 PSD を逐次更新する。
+    新しいフレームは指定座標（または全格子点）の速さだけを取り出して StreamingWelch に加える。
+    snapshot_interval 秒ごとに PSD と加振周波数の振幅をファイルに書き直す。Ctrl+C で終了する。
+    """
+    save_path = input("スナップショットを保存するフォルダのパスを入力: ")
+    target = input("対象を選択 (1: 指定座標, 2: 全格子点) [1]: ").strip() or "1"
+    points = None
+    if target != "2":
+        points = parse_points(input("座標 X,Y を入力 (複数は ; で区切る 例: 24,8; 32,16): "))
+    nperseg = int(input("Welch のセグメント長（点数）を入力 [256]: ").strip() or "256")
+    snapshot_interval = float(input("スナップショットを更新する間隔(秒) [30]: ").strip() or "30")
+    first_input = input("最初のフレームの番号を入力（空欄でフォルダが落ち着いてから最小の番号）: ").strip()
+    
+    folder_name = os.path.basename(os.path.normpath(folder_path))
+    default_forcing = forcing_frequency_from_name(folder_name)
+    forcing_input = input(f"加振周波数(Hz)を入力 [{default_forcing}]: ").strip()
+    forcing_freq = float(forcing_input) if forcing_input else default_forcing
+    
+    os.makedirs(save_path, exist_ok=True)
+    follower = FrameFollower(folder_path, int(first_input) if first_input else None)
+    welch = None
+    rows = expected_xy = cells = grid = None
+    
+    def add_frame(number, file_path):
+        nonlocal welch, rows, expected_xy, cells, grid, points
+        if welch is None:
+            # 最初のフレームで座標 → 行番号（全格子点なら格子）を一度だけ求める
+            first = load_frame(file_path)
+            if points is not None:
+                index = build_grid_index(first)
+                for x, y in points:
+                    if (x, y) not in index:
+                        print(f"座標 ({x:g}, {y:g}) のデータが見つかりませんでした。")
+                points = [p for p in points if p in index]
+                rows = np.array([index[p] for p in points], dtype=np.intp)
+                expected_xy = first[rows, :2]
+                welch = StreamingWelch(time_interval, nperseg, (len(points),))
+            else:
+                x, y, cells = infer_grid(first)
+                grid = (x, y)
+                welch = StreamingWelch(time_interval, nperseg, (len(y), len(x)))
+        if points is not None:
+            values = load_rows(file_path, rows, expected_xy)[:, COL_SPEED]
+        else:
+            values = np.empty(welch.buffer.shape[1:])
+            values.reshape(-1)[cells] = load_frame(file_path)[:, COL_SPEED]
+        welch.add(values, number)
+    
+    def write_snapshot():
+        freq, psd = welch.psd()
+        if psd is None:
+            print(f"{welch.frames} フレーム: セグメント長 {nperseg} に届くまで待っています。")
+            return
+        k = int(np.argmin(np.abs(freq - forcing_freq))) if forcing_freq is not None else None
+        if points is not None:
+            output_path = os.path.join(save_path, f"{folder_name}_live_spectrum.txt")
+            write_atomically(output_path, lambda path: save_point_spectra(path, freq, psd, points))
+            for i, (x, y) in enumerate(points):
+                message = f"  ({x:g}, {y:g}): 卓越周波数 {freq[1:][np.argmax(psd[1:, i])]:.3f} Hz"
+                if k is not None:
+                    message += f", {forcing_freq:g} Hz の振幅 {psd_to_amplitude(psd[k, i], time_interval, nperseg):.4g}"
+                print(message)
+        else:
+            x, y = grid
+            band = (forcing_freq - 0.5, forcing_freq + 0.5) if forcing_freq is not None else (0.0, freq[-1])
+            dominant, band_energy, forcing_amplitude = spectral_maps(freq, psd, time_interval, nperseg, band, forcing_freq)
+            output_path = os.path.join(save_path, f"{folder_name}_live_psd_cube.npz")
+            write_atomically(output_path, lambda path: save_spectral_cube(path, freq, psd, x, y))
+            write_atomically(os.path.join(save_path, f"{folder_name}_live_psd_maps.txt"),
+                             lambda path: save_spectral_maps(path, x, y, dominant, band_energy, forcing_amplitude))
+            mean_psd = psd.reshape(len(freq), -1).mean(axis=1)
+            message = f"  全格子点の平均: 卓越周波数 {freq[1:][np.argmax(mean_psd[1:])]:.3f} Hz"
+            if k is not None:
+                message += f", {forcing_freq:g} Hz の振幅の平均 {np.nanmean(forcing_amplitude):.4g}"
+            print(message)
+        print(f"{welch.frames} フレーム（セグメント {welch.segments} 個）: {output_path} を更新しました。")
+    
+    print(f"{folder_path} を監視します（Ctrl+C で終了）。")
+    last_snapshot = time.monotonic()
+    snapshot_frames = 0
+    try:
+        while True:
+            for number, file_path in follower.poll():
+                try:
+                    add_frame(number, file_path)
+                except (ValueError, OSError) as error:
+                    # 壊れたフレームは欠番として扱い、監視を続ける
+                    print(f"読み込めないためスキップします: {file_path} ({error})")
+            # 前回から新しいフレームが来ていればスナップショットを書き直す
+            if welch is not None and welch.frames != snapshot_frames and time.monotonic() - last_snapshot >= snapshot_interval:
+                write_snapshot()
+                last_snapshot = time.monotonic()
+                snapshot_frames = welch.frames
+            time.sleep(min(DEFAULT_POLL_INTERVAL, snapshot_interval))
+    except KeyboardInterrupt:
+        print("監視を終了します。")
+    if welch is not None:
+        write_snapshot()
+
 def main():
     folder_path = input("フォルダのパスを入力: ")
-    target_x = float(input("X座標を入力: "))
-    target_y = float(input("Y座標を入力: "))
+    mode = input("モードを選択 (1: 指定座標のFFT, 2: 全格子点のPSDマップ, 3: 計測中のフォルダを追跡してスペクトルを逐次更新) [1]: ").strip() or "1"
+    
+    if mode == "3":
+        time_interval_input = input("データの時間間隔（秒）を入力 (例: 1/60 または 0.0166): ")
+        try:
+            time_interval = float(eval(time_interval_input))
+        except Exception as e:
+            print(f"入力エラー: {e}")
+            return
+        live_spectrum_monitor(folder_path, time_interval)
+        return
+    
+    if mode == "2":
+        time_interval_input = input("データの時間間隔（秒）を入力 (例: 1/60 または 0.0166): ")
+        try:
+            time_interval = float(eval(time_interval_input))
+        except Exception as e:
+            print(f"入力エラー: {e}")
+            return
+        field_psd_map(folder_path, time_interval)
+        return
+    
+    points = parse_points(input("座標 X,Y を入力 (複数は ; で区切る 例: 24,8; 32,16): "))
     
     time_interval_input = input("データの時間間隔（秒）を入力 (例: 1/60 または 0.0166): ")
     try:
@@ -44,16 +242,19 @@ def main():
         print(f"入力エラー: {e}")
         return
     
-    velocity_data = load_data_from_folder(folder_path, target_x, target_y)
+    velocity_data, found, missing = load_data_from_folder(folder_path, points)
     
-    if len(velocity_data) == 0:
-        print("指定した座標のデータが見つかりませんでした。")
+    for x, y in missing:
+        print(f"座標 ({x:g}, {y:g}) のデータが見つかりませんでした。")
+    if not found:
         return
     
     freq, fft_values = perform_fft(velocity_data, time_interval)
     
     plt.figure(figsize=(12, 6))
-    plt.plot(freq, fft_values)
+    for i, (x, y) in enumerate(found):
+        plt.plot(freq, fft_values[:, i], label=f"({x:g}, {y:g})")
+    plt.legend()
     plt.xlabel("周波数 (Hz)", fontname='MS Gothic')
     plt.ylabel("振幅", fontname='MS Gothic')
     plt.title("速度データのFFT", fontname='MS Gothic')
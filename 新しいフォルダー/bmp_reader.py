@@ -0,0 +1,148 @@
+import struct
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+_FILE_HEADER = struct.Struct("<2sIHHI")
+_INFO_HEADER = struct.Struct("<IiiHHIIiiII")
+
+# 先読みでページを読み込ませるときの間隔（1ページに1バイト触れれば OS がページ全体を読む）
+_PAGE_SIZE = 4096
+
+# 既定で先読みする枚数
+DEFAULT_PREFETCH = 4
+
+
+def read_bmp_header(raw):
+    """
+    BMP のヘッダを解析する。
+    (画素データの開始位置, 幅, 高さ, ビット数, 下から上への行順か, パレット) を返す。
+    """
+    magic, _, _, _, offset = _FILE_HEADER.unpack_from(raw, 0)
+    if magic != b"BM":
+        raise ValueError("BMP ファイルではありません")
+    (info_size, width, height, _, bit_count, compression,
+     _, _, _, colors_used, _) = _INFO_HEADER.unpack_from(raw, _FILE_HEADER.size)
+    if compression not in (0, 3) or bit_count not in (8, 24, 32):
+        raise ValueError(f"未対応の BMP 形式です (bit={bit_count}, compression={compression})")
+
+    palette = None
+    if bit_count == 8:
+        palette_start = _FILE_HEADER.size + info_size
+        num_colors = colors_used or 256
+        palette = np.frombuffer(raw, dtype=np.uint8, count=num_colors * 4, offset=palette_start).reshape(-1, 4)
+
+    return offset, width, abs(height), bit_count, height > 0, palette
+
+
+def bmp_pixels(raw):
+    """
+    BMP のバイト列（bytes / memmap）から画素を (高さ, 幅) の uint8 グレースケールで返す。
+    8bit グレーパレットで上から下の行順なら、コピーせずに raw のビューを返す。
+    """
+    offset, width, height, bit_count, bottom_up, palette = read_bmp_header(raw)
+    channels = bit_count // 8
+    stride = (width * channels + 3) & ~3  # 各行は4バイト境界に揃えられている
+
+    rows = np.frombuffer(raw, dtype=np.uint8, count=stride * height, offset=offset).reshape(height, stride)
+    pixels = rows[:, :width * channels].reshape(height, width, channels)
+    if bottom_up:
+        pixels = pixels[::-1]
+
+    if bit_count == 8:
+        gray = pixels[..., 0]
+        if not np.array_equal(palette[:, 0], np.arange(len(palette))) or \
+                not (np.array_equal(palette[:, 0], palette[:, 1]) and np.array_equal(palette[:, 1], palette[:, 2])):
+            # グレー以外（または順序の違う）パレットは輝度に変換する
+            lut = (0.114 * palette[:, 0] + 0.587 * palette[:, 1] + 0.299 * palette[:, 2]).astype(np.uint8)
+            gray = lut[gray]
+        return gray
+
+    # 24/32bit は BGR(A) から輝度に変換する
+    return (0.114 * pixels[..., 0] + 0.587 * pixels[..., 1] + 0.299 * pixels[..., 2]).astype(np.uint8)
+
+
+def load_bmp(file_path):
+    """
+    BMP 画像を (高さ, 幅) の uint8 グレースケール配列で読み込む。
+    """
+    with open(file_path, "rb") as f:
+        raw = f.read()
+    return bmp_pixels(raw)
+
+
+def map_bmp(file_path):
+    """
+    BMP 画像をメモリマップして (高さ, 幅) の uint8 グレースケール配列で返す。
+    8bit グレーパレットならファイルのページを直接指すビューになり、コピーしない。
+    """
+    return bmp_pixels(np.memmap(file_path, dtype=np.uint8, mode="r"))
+
+
+def _map_and_touch(file_path):
+    """ メモリマップした画像の全ページに触れて、ディスクからの読み込みを済ませておく """
+    raw = np.memmap(file_path, dtype=np.uint8, mode="r")
+    raw[::_PAGE_SIZE].max()
+    return bmp_pixels(raw)
+
+
+class BmpSequenceReader:
+    """
+    連番 BMP をメモリマップで読み、次の prefetch 枚をバックグラウンドのスレッドで先読みする。
+    画像の組 (n, n+1) は同じ画像のビューを共有するので、各画像は1回だけ読む。
+
+        with BmpSequenceReader(paths) as reader:
+            for image_a, image_b in reader.pairs():
+                ...
+    """
+
+    def __init__(self, file_paths, prefetch=DEFAULT_PREFETCH):
+        self.file_paths = list(file_paths)
+        self.prefetch = prefetch
+        self._executor = ThreadPoolExecutor(max_workers=1) if prefetch > 0 else None
+        self._pending = OrderedDict()
+
+    def __len__(self):
+        return len(self.file_paths)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            for future in self._pending.values():
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._pending.clear()
+
+    def _schedule(self, index):
+        if index < len(self.file_paths) and index not in self._pending:
+            self._pending[index] = self._executor.submit(_map_and_touch, self.file_paths[index])
+
+    def frame(self, index):
+        """ index 番目の画像を返し、その先 prefetch 枚の読み込みを予約する """
+        if self._executor is None:
+            return map_bmp(self.file_paths[index])
+
+        self._schedule(index)
+        for ahead in range(index + 1, index + 1 + self.prefetch):
+            self._schedule(ahead)
+        image = self._pending[index].result()
+
+        # 直前の画像（組で共有する分）より古いものは手放す
+        for old in [i for i in self._pending if i < index - 1 or i > index + self.prefetch]:
+            self._pending.pop(old).cancel()
+        return image
+
+    def pair(self, index, offset=1):
+        """ 画像の組 (index, index + offset) を返す """
+        return self.frame(index), self.frame(index + offset)
+
+    def pairs(self, offset=1):
+        """ 連続する組 (0, 1), (1, 2), ... を順に返す """
+        for index in range(len(self.file_paths) - offset):
+            yield self.pair(index, offset)
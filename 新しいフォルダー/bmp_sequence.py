@@ -0,0 +1,152 @@
+import os
+import json
+import re
+from piv_io import CACHE_DIR_NAME
+from piv_sequence import format_ranges
+
+# 連番画像のファイル名: 共通名 + 6桁の番号
+BMP_PATTERN = re.compile(r'^(.*?)(\d{6})\.bmp$')
+
+# 親フォルダの CACHE_DIR_NAME に置く、フォルダごとの連番情報のキャッシュ
+SEQUENCE_CACHE_NAME = "bmp_sequences.json"
+# 連番情報の項目を変えたら上げる（古い形式のキャッシュは使わない）
+SEQUENCE_CACHE_VERSION = 2
+
+# このプロセスで調べたフォルダの連番情報 {フォルダ: 連番情報}（フォルダの更新時刻が同じ間だけ使う）
+_sequence_memo = {}
+
+def scan_bmp_sequence(folder):
+    """
+    フォルダを1回だけ列挙し、連番画像の情報を返す。bmp がなければ None。
+    {"mtime_ns", "name", "first", "last", "count", "missing", "duplicates"}
+    name は最も番号の小さい画像の共通名、first/last は番号の範囲、missing は範囲内で欠けている番号、
+    duplicates は共通名の違う画像が同じ番号で複数ある番号。
+    共通名が連番の形式に合う画像がなければ name は None。
+    """
+    numbers = {}
+    duplicates = set()
+    has_bmp = False
+    mtime_ns = os.stat(folder).st_mtime_ns
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.name.lower().endswith('.bmp'):
+                continue
+            has_bmp = True
+            match = BMP_PATTERN.match(entry.name)
+            if match:
+                base_name, number = match.groups()
+                if int(number) in numbers:
+                    duplicates.add(int(number))
+                numbers.setdefault(int(number), base_name)
+
+    if not has_bmp:
+        return None
+    if not numbers:
+        return {"mtime_ns": mtime_ns, "name": None, "first": None, "last": None, "count": 0, "missing": [], "duplicates": []}
+
+    first, last = min(numbers), max(numbers)
+    missing = [n for n in range(first, last + 1) if n not in numbers] if len(numbers) != last - first + 1 else []
+    return {"mtime_ns": mtime_ns, "name": numbers[first], "first": first, "last": last,
+            "count": len(numbers), "missing": missing, "duplicates": sorted(duplicates)}
+
+def _load_sequence_cache(cache_path):
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache.get("folders", {}) if cache.get("version") == SEQUENCE_CACHE_VERSION else {}
+
+def _save_sequence_cache(cache_path, sequences):
+    """ キャッシュを書き込む。書き込めない場所（読み取り専用など）では何もしない """
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": SEQUENCE_CACHE_VERSION, "folders": sequences}, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+def discover_sequences(base_path, use_cache=True):
+    """
+    親フォルダ直下の各フォルダの連番情報を {フォルダの絶対パス: 連番情報} で返す（bmp のあるフォルダのみ）。
+    フォルダの更新時刻（ファイルの追加・削除で変わる）が前回と同じなら、中身を列挙せずキャッシュを使う。
+    """
+    base_path = os.path.abspath(base_path)
+    cache_path = os.path.join(base_path, CACHE_DIR_NAME, SEQUENCE_CACHE_NAME)
+    cached = _load_sequence_cache(cache_path) if use_cache else {}
+
+    sequences = {}
+    scanned = {}
+    with os.scandir(base_path) as entries:
+        folders = sorted((entry.name, entry.stat().st_mtime_ns) for entry in entries
+                         if entry.is_dir() and not entry.name.startswith('.') and entry.name != CACHE_DIR_NAME)
+
+    for folder_name, mtime_ns in folders:
+        folder = os.path.join(base_path, folder_name)
+        info = cached.get(folder_name, {})
+        if info.get("mtime_ns") != mtime_ns:
+            info = scan_bmp_sequence(folder) or {"mtime_ns": mtime_ns, "name": None, "count": 0, "empty": True}
+        scanned[folder_name] = info
+        if not info.get("empty"):
+            sequences[folder] = info
+            _sequence_memo[folder] = info
+
+    if use_cache and scanned != cached:
+        _save_sequence_cache(cache_path, scanned)
+    return sequences
+
+def bmp_sequence_info(folder):
+    """ フォルダの連番情報。このプロセスで調べたばかりで変わっていなければ列挙し直さない """
+    folder = os.path.abspath(folder)
+    info = _sequence_memo.get(folder)
+    if info is None or info["mtime_ns"] != os.stat(folder).st_mtime_ns:
+        info = scan_bmp_sequence(folder)
+        if info is not None:
+            _sequence_memo[folder] = info
+    return info
+
+def available_pairs(first_number, final_num, missing=()):
+    """
+    画像の組 (n, n+1), n = first_number .. final_num-1 のうち、両方の画像がそろっている n を返す。
+    """
+    missing = set(missing)
+    return [n for n in range(first_number, final_num) if n not in missing and n + 1 not in missing]
+
+def print_bmp_report(folder, info):
+    """ 連番画像の欠番・重複を表示する。問題がなければ何も表示しない """
+    name = os.path.basename(folder)
+    if info.get("missing"):
+        print(f"{name}: 欠番 {len(info['missing'])} 個: {format_ranges(info['missing'])}（欠番を含む組は処理しません）")
+    if info.get("duplicates"):
+        print(f"{name}: 番号が重複している画像があります: {format_ranges(info['duplicates'])}")
+
+def get_folders_with_bmp(base_path):
+    """ 指定フォルダ内のフォルダを取得し、bmpファイルがあるフォルダのみ返す """
+    return list(discover_sequences(base_path))
+
+def extract_common_name_and_final_num(folder):
+    """ フォルダ内のbmpファイルから共通名(name)と最終番号(final_num)を取得 """
+    info = bmp_sequence_info(folder)
+    if not info or info["name"] is None:
+        return None, None
+    return info["name"], info["last"]
+
+def create_save_folder(savefolder_pass, bpass):
+    """ Bpassの最終フォルダ名と同じフォルダを savefolder_pass に作成 """
+    folder_name = os.path.basename(bpass)
+    save_path = os.path.join(savefolder_pass, folder_name)
+    os.makedirs(save_path, exist_ok=True)
+    return save_path
+
+def bmp_path(bpass, name, number):
+    """ 連番画像のパス（例: name000001.bmp）"""
+    return os.path.join(bpass, f"{name}{number:06d}.bmp")
+
+def vector_path(b_savefolder_pass, name, number):
+    """ 連番画像 number と number+1 の組から作るベクトルファイルのパス """
+    return os.path.join(b_savefolder_pass, f"{name}{number:06d}.txt")
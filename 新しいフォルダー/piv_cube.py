@@ -0,0 +1,184 @@
+import os
+import numpy as np
+from piv_io import load_frame, try_load_frame, load_rows, FRAME_COLUMNS, FRAME_DTYPE, FRAME_EXTENSIONS
+
+# フレーム内の列番号
+COL_X, COL_Y, COL_U, COL_V, COL_SPEED, COL_FLAG = range(6)
+# PIV エンジン（piv_engine.build_frame）が相関ピーク比（主ピーク / 2番目のピーク）を書き込む列。
+# PIV ソフトの出力ではこの列にソフト固有の値が入っているので、ピーク比として使えない
+COL_PEAK_RATIO = 6
+
+# キューブの成分軸は x, y を除いた列（u, v, 速さ, フラグ, 7・8 列目）
+COMPONENT_COLUMNS = FRAME_COLUMNS - 2
+
+
+def list_frame_files(folder_path):
+    """
+    フォルダ内のフレームファイル名（.txt / .npy）を並べ替えて返す。
+    """
+    return sorted(f for f in os.listdir(folder_path) if f.endswith(FRAME_EXTENSIONS))
+
+
+def infer_grid(frame):
+    """
+    1フレームの x, y 列から格子を推定する。
+    x座標, y座標, 各行の格子上の位置(iy * W + ix) を返す。
+    """
+    x = np.unique(frame[:, COL_X])
+    y = np.unique(frame[:, COL_Y])
+    ix = np.searchsorted(x, frame[:, COL_X])
+    iy = np.searchsorted(y, frame[:, COL_Y])
+    cells = iy * len(x) + ix
+
+    if len(frame) != len(x) * len(y) or len(np.unique(cells)) != len(frame):
+        raise ValueError("x, y 列が長方形の格子になっていません")
+    return x, y, cells
+
+
+class VelocityCube:
+    """
+    フォルダ内の全フレームを (時間, 格子行, 格子列, 成分) の連続配列にまとめたもの。
+    u, v, speed, flag はコピーを作らないビュー。
+    """
+
+    def __init__(self, data, x, y, cells, file_names):
+        self.data = data
+        self.x = x
+        self.y = y
+        self.cells = cells
+        self.file_names = file_names
+
+    @property
+    def u(self):
+        return self.data[..., COL_U - 2]
+
+    @property
+    def v(self):
+        return self.data[..., COL_V - 2]
+
+    @property
+    def speed(self):
+        return self.data[..., COL_SPEED - 2]
+
+    @property
+    def flag(self):
+        return self.data[..., COL_FLAG - 2]
+
+    @property
+    def peak_ratio(self):
+        """ 相関ピーク比。piv_engine で作ったフレームのときだけ意味がある（PIV ソフトの出力では別の値） """
+        return self.data[..., COL_PEAK_RATIO - 2]
+
+    @property
+    def grid_step(self):
+        """ 格子間隔 (px) """
+        return float(self.x[1] - self.x[0]) if len(self.x) > 1 else 0.0
+
+    def index_of(self, target_x, target_y):
+        """
+        座標 (x, y) に対応する格子の (行, 列) を返す。見つからなければ None。
+        """
+        ix = np.searchsorted(self.x, target_x)
+        iy = np.searchsorted(self.y, target_y)
+        if ix < len(self.x) and iy < len(self.y) and self.x[ix] == target_x and self.y[iy] == target_y:
+            return int(iy), int(ix)
+        return None
+
+    def frame(self, t, values=None):
+        """
+        時刻 t のデータを元ファイルと同じ行順の (行数, 8) 配列に戻す。
+        values に (格子行, 格子列, 成分) の配列を渡すとその値で組み立てる。
+        """
+        if values is None:
+            values = self.data[t]
+        out = np.empty((len(self.cells), FRAME_COLUMNS), dtype=FRAME_DTYPE)
+        out[:, COL_X] = self.x[self.cells % len(self.x)]
+        out[:, COL_Y] = self.y[self.cells // len(self.x)]
+        out[:, 2:] = values.reshape(-1, COMPONENT_COLUMNS)[self.cells]
+        return out
+
+
+def iter_frames(folder_path, file_names):
+    """
+    フレームを順に読み、(file_names での位置, フレーム) を返すジェネレータ。
+    読めないファイル（空・書き込み途中など）と、格子が最初に読めたフレームと異なるファイルは名前を表示して飛ばす。
+    """
+    first = None
+    for t, file in enumerate(file_names):
+        frame = try_load_frame(os.path.join(folder_path, file))
+        if frame is None:
+            continue
+        if first is None:
+            first = frame
+        elif frame.shape != first.shape or not np.array_equal(frame[:, :2], first[:, :2]):
+            print(f"格子が最初のフレームと異なるためスキップします: {file}")
+            continue
+        yield t, frame
+
+
+def load_cube(folder_path, file_names=None):
+    """
+    フォルダ内のフレームを読み込み、VelocityCube を返す。
+    格子は最初に読めたフレームから一度だけ推定し、以降のフレームは配列比較で一致を確認する。
+    読めないフレームは飛ばす（cube.file_names は読み込んだフレームだけ。番号は cube_numbers で対応させる）。
+    読めるフレームがなければ None。
+    """
+    if file_names is None:
+        file_names = list_frame_files(folder_path)
+
+    frames = iter_frames(folder_path, file_names)
+    t, first = next(frames, (None, None))
+    if first is None:
+        return None
+    x, y, cells = infer_grid(first)
+
+    data = np.empty((len(file_names), len(y), len(x), COMPONENT_COLUMNS), dtype=FRAME_DTYPE)
+    data[0].reshape(-1, COMPONENT_COLUMNS)[cells] = first[:, 2:]
+    loaded = [file_names[t]]
+    for t, frame in frames:
+        data[len(loaded)].reshape(-1, COMPONENT_COLUMNS)[cells] = frame[:, 2:]
+        loaded.append(file_names[t])
+
+    return VelocityCube(data[:len(loaded)], x, y, cells, loaded)
+
+
+def cube_numbers(cube, file_names, numbers=None):
+    """
+    load_cube(folder_path, file_names) で読めたフレームの番号。飛ばしたフレームの番号は欠番になる。
+    numbers を省く（または空の）ときは file_names の並び順を番号とみなす。
+    """
+    if numbers is None or len(numbers) == 0:
+        numbers = range(len(file_names))
+    number_of = dict(zip(file_names, numbers))
+    return [number_of[file] for file in cube.file_names]
+
+
+def build_grid_index(frame):
+    """
+    座標 (x, y) → 行番号 の辞書を作る。フォルダごとに最初のフレームから1回だけ作ればよい。
+    """
+    return {(x, y): row for row, (x, y) in enumerate(frame[:, :2].tolist())}
+
+
+def load_point_series(folder_path, points, column=COL_SPEED, file_names=None):
+    """
+    複数の座標 points [(x, y), ...] の時系列をまとめて読み込む。
+    各フレームからは必要な行だけを読む。
+    (時系列 (時間, 見つかった座標数), 見つかった座標, 見つからなかった座標) を返す。
+    """
+    if file_names is None:
+        file_names = list_frame_files(folder_path)
+    if not file_names:
+        return np.empty((0, 0)), [], list(points)
+
+    first = load_frame(os.path.join(folder_path, file_names[0]))
+    index = build_grid_index(first)
+    found = [p for p in points if p in index]
+    missing = [p for p in points if p not in index]
+    rows = np.array([index[p] for p in found], dtype=np.intp)
+    expected_xy = first[rows, :2]
+
+    series = np.empty((len(file_names), len(found)), dtype=FRAME_DTYPE)
+    for t, file in enumerate(file_names):
+        series[t] = load_rows(os.path.join(folder_path, file), rows, expected_xy)[:, column]
+    return series, found, missing
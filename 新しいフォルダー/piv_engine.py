@@ -0,0 +1,355 @@
+import os
+import numpy as np
+from scipy import fft as sp_fft
+from scipy import ndimage, interpolate
+from bmp_reader import BmpSequenceReader
+from bmp_sequence import bmp_path
+from piv_pairs import frame_schedule, pair_lags, pair_vector_path
+from piv_io import save_frame, FRAME_COLUMNS, FRAME_DTYPE
+from piv_cube import COL_PEAK_RATIO
+
+# 既定の検査窓: 16px 窓を 8px 間隔（50%オーバーラップ）で並べる（PIVソフトの出力と同じ格子）
+DEFAULT_WINDOW = 16
+DEFAULT_STEP = 8
+
+# ピーク比（主ピーク / 2番目のピーク）を求めるとき、主ピークのまわりで除外する範囲 (px)
+PEAK_EXCLUSION_RADIUS = 2
+# 2番目のピークが見つからない（正の値がない）ときのピーク比。ファイルに inf を書かないよう上限を設ける
+PEAK_RATIO_MAX = 100.0
+
+# 多段処理で一度に相関をとる検査窓の数の目安（相関面の作業メモリを抑える）
+WINDOWS_PER_BATCH = 4096
+
+
+def interrogation_grid(shape, window, step):
+    """
+    画像内に収まる検査窓の中心座標 (x, y) を返す。
+    """
+    height, width = shape
+    x = np.arange(window // 2, width - window // 2 + 1, step)
+    y = np.arange(window // 2, height - window // 2 + 1, step)
+    return x, y
+
+
+def extract_windows(image, window, step):
+    """
+    画像から検査窓を (窓の行, 窓の列, window, window) のビューとして切り出す（コピーしない）。
+    """
+    return np.lib.stride_tricks.sliding_window_view(image, (window, window))[::step, ::step]
+
+
+def correlate_windows(windows_a, windows_b):
+    """
+    すべての検査窓の相互相関面を一度の FFT でまとめて求める。
+    相関面は中央 (window // 2) がずれ 0 になるよう並べ替えてある。
+    (相関面, 正規化係数) を返す。
+    """
+    a = windows_a.astype(np.float32)
+    b = windows_b.astype(np.float32)
+    a -= a.mean(axis=(-2, -1), keepdims=True)
+    b -= b.mean(axis=(-2, -1), keepdims=True)
+
+    shape = a.shape[-2:]
+    spectrum = np.conj(sp_fft.rfft2(a, workers=-1)) * sp_fft.rfft2(b, workers=-1)
+    planes = sp_fft.fftshift(sp_fft.irfft2(spectrum, s=shape, workers=-1), axes=(-2, -1))
+
+    norm = np.sqrt((a ** 2).sum(axis=(-2, -1)) * (b ** 2).sum(axis=(-2, -1)))
+    return planes, norm
+
+
+def _subpixel_offset(lower, center, upper):
+    """
+    3点ガウス近似によるサブピクセル補正量（3点がすべて正でないときは放物線近似）。
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        positive = (lower > 0) & (center > 0) & (upper > 0)
+        log_l = np.log(np.where(positive, lower, 1.0))
+        log_c = np.log(np.where(positive, center, 1.0))
+        log_u = np.log(np.where(positive, upper, 1.0))
+        gauss = (log_l - log_u) / (2 * (log_l - 2 * log_c + log_u))
+        parabola = (lower - upper) / (2 * (lower - 2 * center + upper))
+        delta = np.where(positive, gauss, parabola)
+    return np.where(np.isfinite(delta) & (np.abs(delta) < 1), delta, 0.0)
+
+
+def find_peaks(planes, exclusion=PEAK_EXCLUSION_RADIUS):
+    """
+    全相関面のピークをまとめて求める。
+    - 最大値の位置を3点ガウス近似でサブピクセルまで求める（x, y 方向それぞれ）
+    - 最大値のまわり exclusion px を除いた2番目のピークとの比（ピーク比）を求める
+    (dy, dx, ピーク値, ピーク比) を返す。ずれは相関面の中央を 0 とする。
+    """
+    height, width = planes.shape[-2:]
+    flat = planes.reshape(planes.shape[:-2] + (-1,))
+    index = np.argmax(flat, axis=-1)
+    peak = np.take_along_axis(flat, index[..., None], axis=-1)[..., 0]
+    iy, ix = np.divmod(index, width)
+
+    def neighbours(inner, offset):
+        lower = np.take_along_axis(flat, (index - offset * inner)[..., None], axis=-1)[..., 0]
+        upper = np.take_along_axis(flat, (index + offset * inner)[..., None], axis=-1)[..., 0]
+        return lower, upper
+
+    # 端のピークは補正しない（隣の点の代わりにピーク自身を使い、補正量 0 になるようにする）
+    inner_y = (iy > 0) & (iy < height - 1)
+    inner_x = (ix > 0) & (ix < width - 1)
+    lower_y, upper_y = neighbours(inner_y, width)
+    lower_x, upper_x = neighbours(inner_x, 1)
+    dy = iy + np.where(inner_y, _subpixel_offset(lower_y, peak, upper_y), 0.0)
+    dx = ix + np.where(inner_x, _subpixel_offset(lower_x, peak, upper_x), 0.0)
+
+    # 主ピークの近傍を除いた最大値を2番目のピークとする
+    rows = np.arange(height)
+    cols = np.arange(width)
+    near = ((np.abs(rows[:, None] - iy[..., None, None]) <= exclusion) &
+            (np.abs(cols[None, :] - ix[..., None, None]) <= exclusion))
+    secondary = np.where(near, -np.inf, planes).max(axis=(-2, -1))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ratio = np.where(secondary > 0, peak / secondary, PEAK_RATIO_MAX)
+    ratio = np.clip(ratio, 0.0, PEAK_RATIO_MAX)
+
+    return dy - height // 2, dx - width // 2, peak, ratio
+
+
+def build_frame(x, y, dx, dy, peak, norm, dt, scale, ratio=None):
+    """
+    格子上のずれと相関ピークから8列のフレーム (x, y, u, v, 速さ, 相関係数, ピーク比, 0) を作る。
+    輝度変化がなく相関がとれない窓は相関係数の列を -1、ピーク比の列を 0 とする。
+    """
+    valid = norm > 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        coefficient = np.where(valid, peak / norm, -1.0)
+    u = np.where(valid, dx * scale / dt, 0.0)
+    v = np.where(valid, dy * scale / dt, 0.0)
+
+    grid_x, grid_y = np.meshgrid(x, y)
+    frame = np.zeros((grid_x.size, FRAME_COLUMNS), dtype=FRAME_DTYPE)
+    frame[:, 0] = grid_x.ravel()
+    frame[:, 1] = grid_y.ravel()
+    frame[:, 2] = u.ravel()
+    frame[:, 3] = v.ravel()
+    frame[:, 4] = np.hypot(u, v).ravel()
+    frame[:, 5] = coefficient.ravel()
+    if ratio is not None:
+        frame[:, COL_PEAK_RATIO] = np.where(valid, ratio, 0.0).ravel()
+    return frame
+
+
+def piv_pair(image_a, image_b, window=DEFAULT_WINDOW, step=DEFAULT_STEP, dt=1.0, scale=1.0):
+    """
+    2枚の画像から1段（窓の大きさ1つ）で速度ベクトルを求め、8列のフレームを返す。
+    """
+    x, y = interrogation_grid(image_a.shape, window, step)
+    planes, norm = correlate_windows(extract_windows(image_a, window, step),
+                                     extract_windows(image_b, window, step))
+    dy, dx, peak, ratio = find_peaks(planes)
+    return build_frame(x, y, dx, dy, peak, norm, dt, scale, ratio)
+
+
+def _correlate_on_grid(image_a, image_b, window, step):
+    """
+    interrogation_grid(window, step) の全格子点で相関をとり、ピーク位置を返す。
+    (dy, dx, ピーク値, ピーク比, 正規化係数) を返す。
+    格子の行を WINDOWS_PER_BATCH 程度ずつまとめて一括 FFT する（大きな窓でも作業メモリを抑える）。
+    """
+    windows_a = extract_windows(image_a, window, step)
+    windows_b = extract_windows(image_b, window, step)
+    ny, nx = windows_a.shape[:2]
+    dy = np.empty((ny, nx))
+    dx = np.empty((ny, nx))
+    peak = np.empty((ny, nx))
+    ratio = np.empty((ny, nx))
+    norm = np.empty((ny, nx))
+
+    rows_per_batch = max(1, WINDOWS_PER_BATCH // nx)
+    for start in range(0, ny, rows_per_batch):
+        rows = slice(start, min(start + rows_per_batch, ny))
+        planes, norm[rows] = correlate_windows(windows_a[rows], windows_b[rows])
+        dy[rows], dx[rows], peak[rows], ratio[rows] = find_peaks(planes)
+
+    return dy, dx, peak, ratio, norm
+
+
+def interpolate_field(x, y, field, target_x, target_y):
+    """
+    格子 (x, y) 上の場を、直交格子 target_x × target_y に双一次補間する。
+    格子の外側は端の値で延長する。結果は (len(target_y), len(target_x))。
+    """
+    spline = interpolate.RectBivariateSpline(y, x, field, kx=1, ky=1)
+    return spline(np.clip(target_y, y[0], y[-1]), np.clip(target_x, x[0], x[-1]))
+
+
+def deform_image(image, shift_x, shift_y, factor, order=3):
+    """
+    画素ごとのずれ (shift_x, shift_y) の factor 倍だけずらした位置で画像を再標本化する。
+    """
+    height, width = image.shape
+    rows, cols = np.mgrid[0:height, 0:width].astype(np.float32)
+    return ndimage.map_coordinates(image.astype(np.float32), [rows + factor * shift_y, cols + factor * shift_x],
+                                   order=order, mode="constant", cval=0.0)
+
+
+def piv_pair_multipass(image_a, image_b, windows=(64, 32, DEFAULT_WINDOW), step=DEFAULT_STEP, dt=1.0, scale=1.0):
+    """
+    窓を段階的に小さくしながら（例: 64→32→16 px）ずれを求める多段 PIV。
+    前段のずれを予測値として両画像を半分ずつ逆向きに変形し（対称な画像変形）、
+    残りのずれだけを次の段で求める。途中の段は窓の半分の間隔の粗い格子で計算し、
+    最後の段だけ step 間隔の格子で計算する（出力の格子は piv_pair と同じ）。
+    """
+    grid_x = grid_y = dx = dy = None
+
+    for level, window in enumerate(windows):
+        last = level == len(windows) - 1
+        level_step = step if last else max(step, window // 2)
+        x, y = interrogation_grid(image_a.shape, window, level_step)
+
+        if dx is None:
+            deformed_a, deformed_b = image_a, image_b
+            predictor_x = np.zeros((len(y), len(x)))
+            predictor_y = np.zeros((len(y), len(x)))
+        else:
+            # 画素ごとのずれは両画像で共通なので1回だけ補間する。途中の段は双一次、最後の段は3次で変形
+            height, width = image_a.shape
+            shift_x = interpolate_field(grid_x, grid_y, dx, np.arange(width), np.arange(height))
+            shift_y = interpolate_field(grid_x, grid_y, dy, np.arange(width), np.arange(height))
+            order = 3 if last else 1
+            deformed_a = deform_image(image_a, shift_x, shift_y, -0.5, order)
+            deformed_b = deform_image(image_b, shift_x, shift_y, 0.5, order)
+            predictor_x = interpolate_field(grid_x, grid_y, dx, x, y)
+            predictor_y = interpolate_field(grid_x, grid_y, dy, x, y)
+
+        residual_y, residual_x, peak, ratio, norm = _correlate_on_grid(deformed_a, deformed_b, window, level_step)
+        dx = predictor_x + np.where(norm > 0, residual_x, 0.0)
+        dy = predictor_y + np.where(norm > 0, residual_y, 0.0)
+        grid_x, grid_y = x, y
+
+        if not last:
+            # 次段の予測値は 3x3 メディアンで外れ値を抑える
+            dx = ndimage.median_filter(dx, size=3, mode="nearest")
+            dy = ndimage.median_filter(dy, size=3, mode="nearest")
+
+    return build_frame(grid_x, grid_y, dx, dy, peak, norm, dt, scale, ratio)
+
+
+def _pair_images(bpass, name, pairs):
+    """
+    組 (a, b) ごとに (組の位置, a, b, 画像 a, 画像 b) を順に返す。
+    複数の組で使う画像も読み込みは1回だけで、最後に使う組を処理したら手放す。
+    画像はメモリマップで読み、相関を計算している間に次の画像を先読みする。
+    """
+    order, last_use = frame_schedule(pairs)
+    position = {number: i for i, number in enumerate(order)}
+    images = {}
+
+    with BmpSequenceReader([bmp_path(bpass, name, number) for number in order]) as reader:
+        for i, (a, b) in enumerate(pairs):
+            for number in (a, b):
+                if number not in images:
+                    images[number] = reader.frame(position[number])
+
+            yield i, a, b, images[a], images[b]
+
+            for number in (a, b):
+                if last_use[number] == i:
+                    del images[number]
+
+
+def process_pairs(bpass, name, pairs, b_savefolder_pass, window=DEFAULT_WINDOW,
+                  step=DEFAULT_STEP, dt=1.0, scale=1.0, lags=None):
+    """
+    画像の組 (a, b) の一覧を順に処理し、ベクトルファイルを保存する（piv_pairs.plan_pairs の出力）。
+    画像の読み込みは _pair_images 参照。
+    window に (64, 32, 16) のような並びを渡すと多段 PIV で処理する。処理した組の数を返す。
+    """
+    windows = tuple(window) if np.iterable(window) else (window,)
+    if lags is None:
+        lags = pair_lags(pairs)
+
+    for _, a, b, image_a, image_b in _pair_images(bpass, name, pairs):
+        if len(windows) > 1:
+            frame = piv_pair_multipass(image_a, image_b, windows, step, dt, scale)
+        else:
+            frame = piv_pair(image_a, image_b, windows[0], step, dt, scale)
+        output_path = pair_vector_path(b_savefolder_pass, name, (a, b), lags)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        save_frame(output_path, frame)
+    return len(pairs)
+
+
+class EnsembleCorrelation:
+    """
+    アンサンブル相関: すべての組の相関面を検査窓ごとに足し合わせ、最後に1回だけピークを求めて平均場を得る。
+    定常な流れでは、組ごとに PIV をかけてから平均するより速く、粒子の少ない画像でもピークが安定する。
+    組ごとのベクトルファイルは作らない。別々に足し合わせた結果は merge でまとめられる（ワーカーごとの部分和）。
+    """
+
+    def __init__(self, shape, window=DEFAULT_WINDOW, step=DEFAULT_STEP):
+        self.shape = tuple(shape)
+        self.window = window
+        self.step = step
+        self.x, self.y = interrogation_grid(self.shape, window, step)
+        self.planes = np.zeros((len(self.y), len(self.x), window, window))
+        self.norm = np.zeros((len(self.y), len(self.x)))
+        self.count = 0
+
+    def _row_batches(self):
+        rows_per_batch = max(1, WINDOWS_PER_BATCH // len(self.x))
+        for start in range(0, len(self.y), rows_per_batch):
+            yield slice(start, min(start + rows_per_batch, len(self.y)))
+
+    def add(self, image_a, image_b):
+        """ 1組の相関面を足し込む """
+        if image_a.shape != self.shape or image_b.shape != self.shape:
+            raise ValueError(f"画像の大きさ {image_a.shape} が最初の画像 {self.shape} と異なります")
+        windows_a = extract_windows(image_a, self.window, self.step)
+        windows_b = extract_windows(image_b, self.window, self.step)
+        for rows in self._row_batches():
+            planes, norm = correlate_windows(windows_a[rows], windows_b[rows])
+            self.planes[rows] += planes
+            self.norm[rows] += norm
+        self.count += 1
+
+    def merge(self, other):
+        """ 同じ条件で足し合わせた別の結果を加える """
+        if (other.shape, other.window, other.step) != (self.shape, self.window, self.step):
+            raise ValueError("画像の大きさ・検査窓・間隔が異なる結果はまとめられません")
+        self.planes += other.planes
+        self.norm += other.norm
+        self.count += other.count
+        return self
+
+    def frame(self, dt=1.0, scale=1.0):
+        """
+        足し合わせた相関面のピークから平均場の8列のフレームを作る。
+        相関係数の列は (ピークの和) / (正規化係数の和) になる。
+        """
+        dy = np.empty(self.norm.shape)
+        dx = np.empty(self.norm.shape)
+        peak = np.empty(self.norm.shape)
+        ratio = np.empty(self.norm.shape)
+        for rows in self._row_batches():
+            dy[rows], dx[rows], peak[rows], ratio[rows] = find_peaks(self.planes[rows])
+        return build_frame(self.x, self.y, dx, dy, peak, self.norm, dt, scale, ratio)
+
+
+def ensemble_pairs(bpass, name, pairs, window=DEFAULT_WINDOW, step=DEFAULT_STEP):
+    """
+    画像の組 (a, b) の一覧の相関面を足し合わせた EnsembleCorrelation を返す（ファイルは保存しない）。
+    組の時間間隔はすべて同じであること。
+    """
+    correlation = None
+    for _, a, b, image_a, image_b in _pair_images(bpass, name, pairs):
+        if correlation is None:
+            correlation = EnsembleCorrelation(image_a.shape, window, step)
+        correlation.add(image_a, image_b)
+    return correlation
+
+
+def process_pair_range(bpass, name, start, stop, b_savefolder_pass, window=DEFAULT_WINDOW,
+                       step=DEFAULT_STEP, dt=1.0, scale=1.0):
+    """
+    連番画像の組 (n, n+1) を n = start .. stop-1 について処理し、ベクトルファイルを保存する。
+    隣り合う組で共有する画像は1回だけ読む。処理した組の数を返す。
+    """
+    pairs = [(number, number + 1) for number in range(start, stop)]
+    return process_pairs(bpass, name, pairs, b_savefolder_pass, window, step, dt, scale)
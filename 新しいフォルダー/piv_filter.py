@@ -0,0 +1,237 @@
+import itertools
+import os
+import tempfile
+import numpy as np
+from scipy import fft as sp_fft
+from scipy import signal
+from piv_io import save_frame_pairs, FRAME_COLUMNS, FRAME_DTYPE
+from piv_cube import iter_frames, COL_U, COL_SPEED, COMPONENT_COLUMNS
+from piv_sequence import has_gaps, contiguous_segments, fill_gaps, GAP_SPLIT, GAP_INTERPOLATE
+
+# 時間方向にフィルタをかける成分（キューブの成分軸で u, v, 速さ）
+VELOCITY_COMPONENTS = slice(COL_U - 2, COL_SPEED - 2 + 1)
+
+# IIR（Butterworth）ローパスの既定の次数
+DEFAULT_IIR_ORDER = 4
+
+
+def temporal_lowpass(values, time_interval, cutoff, axis=0):
+    """
+    values の axis 方向（時間軸）に FFT ローパスをかける。
+    すべての格子点・成分を一度の実数 FFT でまとめて処理する。
+    """
+    n = values.shape[axis]
+    freq = np.fft.rfftfreq(n, time_interval)
+    spectrum = sp_fft.rfft(values, axis=axis, workers=-1)
+
+    index = [slice(None)] * spectrum.ndim
+    index[axis] = freq > cutoff
+    spectrum[tuple(index)] = 0  # 指定カットオフ周波数以上をゼロにする
+
+    return sp_fft.irfft(spectrum, n=n, axis=axis, workers=-1)
+
+
+def lowpass_series(values, time_interval, cutoff, numbers=None, gaps=GAP_SPLIT):
+    """
+    時間軸が先頭の values にローパスをかけた配列を返す。numbers（各フレームの番号）に欠番があるとき、
+    - GAP_SPLIT: 番号が連続した区間ごとに別々にフィルタする
+    - GAP_INTERPOLATE: 欠番を前後のフレームから線形補間して埋めてからフィルタし、元のフレームだけ返す
+    """
+    if numbers is None or not has_gaps(numbers):
+        return temporal_lowpass(values, time_interval, cutoff, axis=0)
+
+    if gaps == GAP_INTERPOLATE:
+        filled, _, position = fill_gaps(values, numbers)
+        return temporal_lowpass(filled, time_interval, cutoff, axis=0)[position]
+
+    filtered = np.empty(values.shape, dtype=np.result_type(values, np.float64))
+    for segment in contiguous_segments(numbers):
+        filtered[segment] = temporal_lowpass(values[segment], time_interval, cutoff, axis=0)
+    return filtered
+
+
+def lowpass_cube(cube, time_interval, cutoff, numbers=None, gaps=GAP_SPLIT):
+    """
+    VelocityCube の u, v, 速さを時間方向にローパスする（キューブを書き換える）。
+    numbers を渡すと欠番を gaps の方法で扱う（lowpass_series 参照）。
+    """
+    velocity = cube.data[..., VELOCITY_COMPONENTS]
+    velocity[...] = lowpass_series(velocity, time_interval, cutoff, numbers, gaps)
+    return cube
+
+
+def _points_per_tile(num_frames, memory_budget, series_length=None):
+    """
+    メモリ上限に収まる1タイルあたりの格子点数を求める。
+    1点あたり: 全成分の時系列 + FFT の作業領域（実数・複素数・逆変換結果）
+    series_length はフィルタにかける時系列の長さ（欠番を補間して埋めるときは埋めた後の長さ）。省くと num_frames。
+    """
+    if series_length is None:
+        series_length = num_frames
+    bytes_per_point = num_frames * COMPONENT_COLUMNS * 8 + series_length * 3 * 8 * 4
+    return max(1, int(memory_budget // bytes_per_point))
+
+
+def lowpass_folder_chunked(folder_path, file_names, output_paths, time_interval, cutoff,
+                           memory_budget, scratch_dir=None, binary=False, workers=1,
+                           numbers=None, gaps=GAP_SPLIT, validator=None):
+    """
+    全フレームをメモリに載せずに時間方向ローパスをかける。
+    1. 各フレームを空間タイルに分けてメモリマップの作業ファイルに転置して書き込む
+    2. タイルごとに全時系列を読み出してフィルタし、作業ファイルに書き戻す
+    3. フレームごとに各タイルから値を集めて出力ファイルに書き出す
+    ピークメモリは memory_budget（バイト）程度に抑えられる。欠番の扱いは lowpass_series と同じ。
+    validator（piv_validate.VectorValidator）を渡すと、1 の段階で各フレームの外れ値を近傍から補間してからフィルタする。
+    読めないフレームは飛ばし、その番号は欠番として扱う（出力もしない）。
+    """
+    num_frames = len(file_names)
+    if numbers is None:
+        numbers = range(num_frames)
+    frames = iter_frames(folder_path, file_names)
+    first = next(frames, (None, None))
+    if first[1] is None:
+        raise ValueError(f"{folder_path}: 読み込めるフレームがありません")
+    grid_xy = first[1][:, :2].copy()
+    num_points = len(grid_xy)
+
+    # 欠番を補間するときは、埋めた後の長さ（最初から最後の番号まで）の時系列をフィルタにかける
+    series_length = num_frames
+    if gaps == GAP_INTERPOLATE and has_gaps(numbers):
+        series_length = numbers[-1] - numbers[0] + 1
+    tile_points = min(num_points, _points_per_tile(num_frames, memory_budget, series_length))
+    num_tiles = -(-num_points // tile_points)
+    padded = num_tiles * tile_points
+
+    fd, scratch_path = tempfile.mkstemp(suffix=".scratch", dir=scratch_dir)
+    os.close(fd)
+    scratch = None
+    try:
+        # タイル × 時間 × タイル内の点 × 成分（タイルの時系列が連続領域になる並び）
+        scratch = np.memmap(scratch_path, dtype=FRAME_DTYPE, mode="w+",
+                            shape=(num_tiles, num_frames, tile_points, COMPONENT_COLUMNS))
+        values = np.zeros((padded, COMPONENT_COLUMNS), dtype=FRAME_DTYPE)
+
+        loaded = []  # 読み込めたフレームの file_names での位置
+        for t, frame in itertools.chain([first], frames):
+            if validator is not None:
+                frame = validator.frame(frame)[0]
+            values[:num_points] = frame[:, 2:]
+            scratch[:, len(loaded)] = values.reshape(num_tiles, tile_points, COMPONENT_COLUMNS)
+            loaded.append(t)
+        del first
+        loaded_numbers = [numbers[t] for t in loaded]
+
+        for k in range(num_tiles):
+            tile = np.array(scratch[k, :len(loaded), :, VELOCITY_COMPONENTS])
+            scratch[k, :len(loaded), :, VELOCITY_COMPONENTS] = lowpass_series(tile, time_interval, cutoff, loaded_numbers, gaps)
+            print(f"フィルタ処理: タイル {k + 1}/{num_tiles}")
+        scratch.flush()
+
+        def filtered_frames():
+            for i, t in enumerate(loaded):
+                frame = np.empty((num_points, FRAME_COLUMNS), dtype=FRAME_DTYPE)
+                frame[:, :2] = grid_xy
+                frame[:, 2:] = scratch[:, i].reshape(padded, COMPONENT_COLUMNS)[:num_points]
+                yield output_paths[t], frame
+
+        save_frame_pairs(filtered_frames(), binary=binary, workers=workers)
+    finally:
+        scratch = None  # メモリマップを閉じてから作業ファイルを削除する（Windows対策）
+        os.remove(scratch_path)
+
+
+class StreamingLowpass:
+    """
+    Butterworth ローパス（2次セクション形式）を、届いた順に1フレームずつかける。
+    持つのは格子点ごとのフィルタ状態だけなので、メモリはフレーム数によらず一定。
+    状態は最初のフレームの値で定常になるよう初期化する（始まりの過渡応答を抑える）。
+    番号（numbers）が飛んだときは、
+    - GAP_SPLIT: 次のフレームから状態を初期化し直す（区間ごとに別々にフィルタするのと同じ）
+    - GAP_INTERPOLATE: 直前のフレームとの間を線形補間したフレームをフィルタに通してから続ける
+    """
+
+    def __init__(self, time_interval, cutoff, order=DEFAULT_IIR_ORDER, gaps=GAP_SPLIT):
+        self.sos = signal.butter(order, cutoff, fs=1.0 / time_interval, output="sos")
+        self.gaps = gaps
+        self._unit_state = signal.sosfilt_zi(self.sos)  # 入力 1 の定常状態 (セクション, 2)
+        self.state = None
+        self.last_number = None
+        self.last_values = None
+
+    def _reset(self, values):
+        self.state = self._unit_state.reshape(self._unit_state.shape + (1,) * values.ndim) * values
+
+    def _step(self, values):
+        filtered, self.state = signal.sosfilt(self.sos, values[None], axis=0, zi=self.state)
+        return filtered[0]
+
+    def add(self, values, number=None):
+        """ 1フレーム分の値（格子点, 成分）を加え、フィルタ後の値を返す """
+        values = np.array(values, dtype=np.float64)  # 呼び出し側が配列を書き換えても補間に使えるようコピーする
+        gap = number is not None and self.last_number is not None and number != self.last_number + 1
+        if self.state is None or (gap and (self.gaps != GAP_INTERPOLATE or number < self.last_number)):
+            self._reset(values)
+        elif gap:
+            span = number - self.last_number
+            for k in range(1, span):
+                self._step(self.last_values + (values - self.last_values) * (k / span))
+
+        filtered = self._step(values)
+        self.last_number = number
+        if self.gaps == GAP_INTERPOLATE:
+            self.last_values = values
+        return filtered
+
+
+def iir_lowpass_folder(folder_path, file_names, output_paths, time_interval, cutoff, order=DEFAULT_IIR_ORDER,
+                       zero_phase=False, scratch_dir=None, binary=False, workers=1,
+                       numbers=None, gaps=GAP_SPLIT, validator=None):
+    """
+    フレームを1つずつ読みながら u, v, 速さに Butterworth ローパスをかけて書き出す。
+    - zero_phase=False: 因果的な1パス。読み込んだフレームから順に書き出すので、全フレームを待たずに始まる
+    - zero_phase=True: 前向きの結果を作業ファイル（メモリマップ）に置き、後ろ向きにもう一度かけて位相遅れを打ち消す
+    どちらもメモリは格子点ごとの状態とフレーム数個分だけで、フレーム数によらない。
+    欠番は StreamingLowpass と同じ方法で扱う。validator を渡すと各フレームの外れ値を補間してからフィルタする。
+    読めないフレームは飛ばし、その番号は欠番として扱う（出力もしない）。
+    """
+    if numbers is None:
+        numbers = list(range(len(file_names)))
+
+    def forward_frames():
+        lowpass = StreamingLowpass(time_interval, cutoff, order, gaps)
+        for t, frame in iter_frames(folder_path, file_names):
+            if validator is not None:
+                frame = validator.frame(frame)[0]
+            frame = frame.astype(FRAME_DTYPE)
+            frame[:, 2:][:, VELOCITY_COMPONENTS] = lowpass.add(frame[:, 2:][:, VELOCITY_COMPONENTS], numbers[t])
+            yield t, frame
+
+    if not zero_phase:
+        save_frame_pairs(((output_paths[t], frame) for t, frame in forward_frames()), binary=binary, workers=workers)
+        return
+
+    fd, scratch_path = tempfile.mkstemp(suffix=".scratch", dir=scratch_dir)
+    os.close(fd)
+    scratch = None
+    try:
+        loaded = []  # 読み込めたフレームの file_names での位置
+        for t, frame in forward_frames():
+            if scratch is None:
+                scratch = np.memmap(scratch_path, dtype=FRAME_DTYPE, mode="w+", shape=(len(file_names),) + frame.shape)
+            scratch[len(loaded)] = frame
+            loaded.append(t)
+        if scratch is None:
+            raise ValueError(f"{folder_path}: 読み込めるフレームがありません")
+        print("前向きのフィルタ処理が終わりました。後ろ向きにもう一度かけます。")
+
+        # 後ろ向きは番号の符号を反転して渡す（番号が1ずつ増える並びとして欠番を判定する）
+        lowpass = StreamingLowpass(time_interval, cutoff, order, gaps)
+        for i in reversed(range(len(loaded))):
+            values = scratch[i, :, 2:][:, VELOCITY_COMPONENTS]
+            scratch[i, :, 2:][:, VELOCITY_COMPONENTS] = lowpass.add(values, -numbers[loaded[i]])
+        scratch.flush()
+
+        save_frame_pairs(((output_paths[t], np.array(scratch[i])) for i, t in enumerate(loaded)), binary=binary, workers=workers)
+    finally:
+        scratch = None  # メモリマップを閉じてから作業ファイルを削除する（Windows対策）
+        os.remove(scratch_path)
@@ -0,0 +1,244 @@
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+
+# キャッシュは各フォルダ内のこのサブフォルダに置く（*.txt の列挙に混ざらないようにする）
+CACHE_DIR_NAME = "__pivcache__"
+CACHE_SUFFIX = ".pivc"
+
+# キャッシュファイルの先頭: マジック + 元テキストのサイズ + 更新時刻(ns)
+_CACHE_MAGIC = b"PIVCACHE"
+_CACHE_HEADER = struct.Struct("<8sqq")
+
+# PIV出力の列構成: x, y, u, v, 速さ, フラグ, PIVソフト固有の値 x2
+# （piv_engine の出力では 7 列目が相関ピーク比、8 列目が 0）
+FRAME_COLUMNS = 8
+FRAME_DTYPE = np.float64
+
+# フレームとして読み込む拡張子（.npy は save_frame(binary=True) の出力）
+FRAME_EXTENSIONS = (".txt", ".npy")
+
+# numpy 1.23 以降の loadtxt は C 実装。それより古い場合は np.fromfile で C 解析する
+_HAS_C_LOADTXT = np.lib.NumpyVersion(np.__version__) >= "1.23.0"
+
+
+def get_cache_path(file_path):
+    """
+    テキストファイルに対応するキャッシュファイルのパスを返す。
+    """
+    folder, name = os.path.split(os.path.abspath(file_path))
+    return os.path.join(folder, CACHE_DIR_NAME, name + CACHE_SUFFIX)
+
+
+def _parse_frame(file_path):
+    """
+    テキストファイル全体を一度に C レベルで解析し、(行数, 8) の配列にする。
+    空のファイル・書き込み途中のファイルなど8列の表として読めないものは ValueError。
+    """
+    if os.path.getsize(file_path) == 0:
+        raise ValueError(f"{file_path}: 空のファイルです")
+    if _HAS_C_LOADTXT:
+        data = np.loadtxt(file_path, dtype=FRAME_DTYPE, comments=None, ndmin=2)
+    else:
+        data = np.fromfile(file_path, dtype=FRAME_DTYPE, sep=" ")
+        if data.size % FRAME_COLUMNS:
+            raise ValueError(f"{file_path}: 値の個数が{FRAME_COLUMNS}列の倍数ではありません")
+        data = data.reshape(-1, FRAME_COLUMNS)
+
+    if data.shape[1] != FRAME_COLUMNS:
+        raise ValueError(f"{file_path}: 列数が{data.shape[1]}です（{FRAME_COLUMNS}列を想定）")
+    return data
+
+
+def _read_cache(cache_path, stat, mmap=False):
+    """
+    キャッシュが元ファイルのサイズ・更新時刻と一致すれば配列を返す。一致しなければ None。
+    mmap=True のときは読み込まずにメモリマップで返す（必要な行だけ読む用）。
+    """
+    try:
+        with open(cache_path, "rb") as f:
+            header = f.read(_CACHE_HEADER.size)
+            if len(header) != _CACHE_HEADER.size:
+                return None
+            magic, size, mtime_ns = _CACHE_HEADER.unpack(header)
+            if magic != _CACHE_MAGIC or size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+                return None
+            if not mmap:
+                return np.lib.format.read_array(f)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        return np.memmap(cache_path, dtype=dtype, mode="r", offset=offset, shape=shape,
+                         order="F" if fortran_order else "C")
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cache(cache_path, stat, data):
+    """
+    キャッシュを書き込む。書き込めない場所（読み取り専用など）では何もしない。
+    """
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            f.write(_CACHE_HEADER.pack(_CACHE_MAGIC, stat.st_size, stat.st_mtime_ns))
+            np.lib.format.write_array(f, np.ascontiguousarray(data), allow_pickle=False)
+        os.replace(tmp_path, cache_path)  # 途中で落ちても壊れたキャッシュを残さない
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def load_frame(file_path, use_cache=True):
+    """
+    1フレーム分のテキストデータ(x, y, u, v, 速さ, ...)を配列で読み込む。
+    有効なバイナリキャッシュがあればそれを読み、なければテキストを解析してキャッシュを作る。
+    save_frame(binary=True) で保存した .npy もそのまま読める。
+    読めないファイル（空・書き込み途中・列数が8でない）は ValueError、ファイルがなければ OSError。
+    """
+    if file_path.endswith(".npy"):
+        try:
+            data = np.load(file_path)
+        except EOFError as error:
+            raise ValueError(f"{file_path}: 空か書き込み途中のファイルです") from error
+        if data.ndim != 2 or data.shape[1] != FRAME_COLUMNS:
+            raise ValueError(f"{file_path}: 形が{data.shape}です（{FRAME_COLUMNS}列を想定）")
+        return data
+    if not use_cache:
+        return _parse_frame(file_path)
+
+    stat = os.stat(file_path)
+    cache_path = get_cache_path(file_path)
+    data = _read_cache(cache_path, stat)
+    if data is None:
+        data = _parse_frame(file_path)
+        _write_cache(cache_path, stat, data)
+    return data
+
+
+def try_load_frame(file_path):
+    """
+    load_frame と同じ。読めないファイルは名前と理由を表示して None を返す（長いバッチを1ファイルで止めない）。
+    """
+    try:
+        return load_frame(file_path)
+    except (ValueError, OSError) as error:
+        print(f"読み込めないためスキップします: {file_path} ({error})")
+        return None
+
+
+def _read_fixed_width_rows(file_path, rows):
+    """
+    PIVソフトの出力は1行の長さが一定なので、行番号 × 行長の位置へ直接シークして指定行だけ解析する。
+    行長が一定でないファイルでは None を返す。
+    """
+    with open(file_path, "rb") as f:
+        width = len(f.readline())
+        lines = []
+        for row in rows:
+            f.seek(int(row) * width)
+            line = f.read(width)
+            if len(line) != width or not line.endswith(b"\n"):
+                return None
+            lines.append(line)
+
+    try:
+        return np.array(b" ".join(lines).split(), dtype=FRAME_DTYPE).reshape(len(lines), FRAME_COLUMNS)
+    except ValueError:
+        return None
+
+
+def load_rows(file_path, rows, expected_xy=None):
+    """
+    フレームの指定行 rows だけを読む。
+    有効なキャッシュがあればメモリマップから、なければ固定長行へのシークで読み、
+    どちらも使えない（または expected_xy と x, y が合わない）ときだけフレーム全体を読む。
+    """
+    rows = np.asarray(rows, dtype=np.intp)
+
+    def matches(data):
+        return data is not None and (expected_xy is None or np.array_equal(data[:, :2], expected_xy))
+
+    if file_path.endswith(".npy"):
+        data = np.array(np.load(file_path, mmap_mode="r")[rows])
+    else:
+        cached = _read_cache(get_cache_path(file_path), os.stat(file_path), mmap=True)
+        data = np.array(cached[rows]) if cached is not None and cached.shape[0] > rows.max(initial=-1) else None
+        if not matches(data):
+            data = _read_fixed_width_rows(file_path, rows)
+        if not matches(data):
+            data = load_frame(file_path)[rows]
+
+    if not matches(data):
+        raise ValueError(f"{file_path} の格子が最初のフレームと異なります")
+    return data
+
+
+# PIVソフトが出力するフレームと同じ書式（x, y は幅5、値は幅15の指数表記）
+FRAME_TEXT_FORMAT = "%5g%5g" + "%15.7e" * (FRAME_COLUMNS - 2)
+# 平均化ツールの *_averaged.txt の書式
+AVERAGED_TEXT_FORMAT = "  ".join(["%g"] * 2 + ["%.8e"] * (FRAME_COLUMNS - 2))
+
+
+def format_rows(data, fmt):
+    """
+    2次元配列全体を1行分の書式 fmt で一度に文字列へ変換する（行ごとの join より速い）。
+    """
+    data = np.asarray(data)
+    return ((fmt + "\n") * len(data)) % tuple(data.ravel().tolist())
+
+
+def frame_output_path(file_path, binary=False):
+    """ save_frame が実際に書き出すパス（binary=True なら拡張子が .npy になる） """
+    return os.path.splitext(file_path)[0] + ".npy" if binary else file_path
+
+
+def save_frame(file_path, data, fmt=FRAME_TEXT_FORMAT, binary=False):
+    """
+    1フレームを書き出す。binary=True のときは拡張子を .npy にしてバイナリで保存する。
+    保存したパスを返す。
+    """
+    file_path = frame_output_path(file_path, binary)
+    if binary:
+        np.save(file_path, np.ascontiguousarray(data, dtype=FRAME_DTYPE))
+    else:
+        text = format_rows(data, fmt)
+        with open(file_path, "w") as f:
+            f.write(text)
+    return file_path
+
+
+def save_frames(file_paths, frames, fmt=FRAME_TEXT_FORMAT, binary=False, workers=1):
+    """
+    複数フレームを書き出す。workers > 1 のときはプロセスを分けて並列に書式化・保存する。
+    frames はジェネレータでもよい（同時に保持するのは workers * 2 フレームまで）。
+    """
+    save_frame_pairs(zip(file_paths, frames), fmt, binary, workers)
+
+
+def save_frame_pairs(pairs, fmt=FRAME_TEXT_FORMAT, binary=False, workers=1):
+    """
+    (保存先, フレーム) の組を順に書き出す（save_frames と同じ。途中で飛ばすフレームがあるとき用）。
+    """
+    if workers <= 1:
+        for file_path, data in pairs:
+            print(f"保存完了: {save_frame(file_path, data, fmt, binary)}")
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for file_path, data in pairs:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    print(f"保存完了: {future.result()}")
+            pending.add(executor.submit(save_frame, file_path, data, fmt, binary))
+        for future in pending:
+            print(f"保存完了: {future.result()}")
@@ -0,0 +1,144 @@
+import shlex
+import subprocess
+import time
+from collections import deque
+from datetime import datetime
+
+# 同時に実行する PIV の数の既定値
+DEFAULT_MAX_CONCURRENCY = 2
+
+# 実行中のジョブの終了を確認する間隔（秒）
+POLL_INTERVAL = 1.0
+
+# テスト用に PIV ソフトの代わりに実行するコマンドを指定する環境変数
+# 例: PIV_COMMAND="python fake_piv.py {bpass} {b_savefolder_pass} {first_number} {final_num}"
+STANDIN_COMMAND_ENV = "PIV_COMMAND"
+
+
+class PivJob:
+    """
+    1つの Bpass フォルダの PIV 処理。
+    status は queued → running → finished / failed と変わる。
+    """
+
+    def __init__(self, bpass, name, first_number, final_num, b_savefolder_pass):
+        self.bpass = bpass
+        self.name = name
+        self.first_number = first_number
+        self.final_num = final_num
+        self.b_savefolder_pass = b_savefolder_pass
+        self.status = "queued"
+        self.process = None
+        self.pid = None
+        self.returncode = None
+        self.started_at = None
+        self.finished_at = None
+        # ランチャーが起動時に設定する: PIV ソフト用のテンポラリフォルダ、インスタンス記録（piv_registry）の id
+        self.temp_folder = None
+        self.registry_id = None
+
+    def fields(self):
+        """ コマンドの {bpass} などに埋め込む値 """
+        return {"bpass": self.bpass, "name": self.name, "first_number": self.first_number,
+                "final_num": self.final_num, "b_savefolder_pass": self.b_savefolder_pass}
+
+    @property
+    def elapsed(self):
+        """ 実行時間（秒）。まだ始まっていなければ None """
+        if self.started_at is None:
+            return None
+        return ((self.finished_at or datetime.now()) - self.started_at).total_seconds()
+
+
+def standin_command(template):
+    """
+    PIV ソフトの代わりに実行するコマンドの雛形（{bpass} などを含む文字列）から command 関数を作る。
+    """
+    parts = shlex.split(template)
+
+    def command(job):
+        return [part.format(**job.fields()) for part in parts]
+    return command
+
+
+class JobScheduler:
+    """
+    PIV ジョブの待ち行列。同時に max_concurrency 個まで起動し、1つ終わるたびに次を起動する。
+    - command(job): 起動するコマンド（引数のリスト）を返す関数
+    - env(job): ジョブの環境変数を返す関数（None なら親の環境をそのまま使う）
+    - on_start(job) / on_finish(job): 起動直後・終了後に呼ぶ関数（GUI への入力や記録など）
+    """
+
+    def __init__(self, command, max_concurrency=DEFAULT_MAX_CONCURRENCY, env=None,
+                 on_start=None, on_finish=None, poll_interval=POLL_INTERVAL, shell=False):
+        self.command = command
+        self.max_concurrency = max(1, max_concurrency)
+        self.env = env
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self.poll_interval = poll_interval
+        self.shell = shell
+        self.queue = deque()
+        self.running = []
+        self.jobs = []
+
+    def submit(self, job):
+        """ ジョブを待ち行列の最後に加える """
+        self.queue.append(job)
+        self.jobs.append(job)
+        return job
+
+    def _start(self, job):
+        env = self.env(job) if self.env else None
+        job.started_at = datetime.now()
+        try:
+            job.process = subprocess.Popen(self.command(job), shell=self.shell, env=env)
+        except OSError as e:
+            print(f"起動に失敗しました: {job.name} ({e})")
+            job.status = "failed"
+            job.finished_at = datetime.now()
+            if self.on_finish:
+                self.on_finish(job)
+            return
+
+        job.pid = job.process.pid
+        job.status = "running"
+        self.running.append(job)
+        print(f"[{job.started_at:%H:%M:%S}] 開始: {job.name} (PID: {job.pid}, 実行中 {len(self.running)}/{self.max_concurrency})")
+        if self.on_start:
+            self.on_start(job)
+
+    def _finish(self, job):
+        job.returncode = job.process.returncode
+        job.finished_at = datetime.now()
+        job.status = "finished" if job.returncode == 0 else "failed"
+        job.process = None
+        self.running.remove(job)
+        print(f"[{job.finished_at:%H:%M:%S}] 終了: {job.name} (終了コード {job.returncode}, {job.elapsed:.1f} 秒)")
+        if self.on_finish:
+            self.on_finish(job)
+
+    def run(self):
+        """ 待ち行列が空になり、実行中のジョブがすべて終わるまで処理する。全ジョブを返す """
+        while self.queue or self.running:
+            while self.queue and len(self.running) < self.max_concurrency:
+                self._start(self.queue.popleft())
+
+            if self.running:
+                time.sleep(self.poll_interval)
+            for job in list(self.running):
+                if job.process.poll() is not None:
+                    self._finish(job)
+
+        return self.jobs
+
+
+def print_summary(jobs):
+    """ ジョブごとの開始・終了時刻と終了状態を一覧表示する """
+    for job in jobs:
+        started = f"{job.started_at:%Y-%m-%d %H:%M:%S}" if job.started_at else "-"
+        finished = f"{job.finished_at:%Y-%m-%d %H:%M:%S}" if job.finished_at else "-"
+        print(f"{job.status:8s} {started} → {finished}  終了コード {job.returncode}  {job.name}")
+
+    failed = [job for job in jobs if job.status == "failed"]
+    print(f"{len(jobs)} 件中 {len(jobs) - len(failed)} 件成功, {len(failed)} 件失敗")
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+# 出力フォルダごとに置く、各処理単位の入力と条件の記録
+MANIFEST_NAME = "piv_manifest.json"
+# PIV の保存先フォルダに置く、完了監視（PIV Completion Watcher.py）の後処理の記録。
+# PIV を実行中のプロセスも同じフォルダの MANIFEST_NAME を書き換えるので、別のファイルにして記録を消し合わないようにする
+POSTPROCESS_MANIFEST_NAME = "piv_postprocess_manifest.json"
+
+
+def input_signature(file_paths):
+    """
+    入力ファイルのパス・サイズ・更新時刻をまとめたハッシュ。ファイルが1つでもなければ None。
+    """
+    digest = hashlib.sha1()
+    try:
+        for path in file_paths:
+            stat = os.stat(path)
+            digest.update(f"{os.path.abspath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode("utf-8"))
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def _normalize(params):
+    """ タプルなどを JSON で読み戻したときと同じ形にそろえる（比較用） """
+    return json.loads(json.dumps(params))
+
+
+class Manifest:
+    """
+    出力フォルダの MANIFEST_NAME（name を渡せばそのファイル）を読み書きする。
+    処理単位（キー）ごとに、入力ファイルのハッシュ・条件・出力ファイルを記録しておき、
+    入力と条件が前回と同じで出力もそろっている単位は処理を省く。
+
+        manifest = Manifest(output_folder)
+        if not manifest.is_current(key, inputs, params, outputs):
+            ...処理...
+            manifest.record(key, inputs, params, outputs)
+            manifest.save()
+    """
+
+    def __init__(self, folder, name=MANIFEST_NAME):
+        self.path = os.path.join(folder, name)
+        self.units = {}
+        self._signatures = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.units = json.load(f)
+        except (OSError, ValueError):
+            pass  # 初回、または壊れた記録はすべて処理し直す
+
+    def _signature(self, key, input_paths):
+        if key not in self._signatures:
+            self._signatures[key] = input_signature(input_paths)
+        return self._signatures[key]
+
+    def is_current(self, key, input_paths, params, output_paths=()):
+        """
+        前回と入力・条件が同じで、出力ファイルもすべて残っていれば True。
+        ここで取った入力のハッシュを record で記録する（処理の前の入力を記録するので、処理中に入力が変われば次回処理し直す）。
+        """
+        signature = self._signature(key, input_paths)
+        unit = self.units.get(key)
+        if unit is None or unit.get("params") != _normalize(params):
+            return False
+        if signature is None or unit.get("inputs") != signature:
+            return False
+        return all(os.path.exists(path) for path in output_paths)
+
+    def record(self, key, input_paths, params, output_paths=()):
+        """ 処理を終えた単位を記録する（ファイルへの書き込みは save で行う） """
+        self.units[key] = {
+            "inputs": self._signatures.pop(key, None) or input_signature(input_paths),
+            "num_inputs": len(input_paths),
+            "params": _normalize(params),
+            "outputs": [os.path.basename(path) for path in output_paths],
+            "recorded_at": datetime.now().isoformat(timespec="seconds"),
+        }
+
+    def save(self):
+        """ 記録を書き出す。途中で落ちても壊れた記録を残さないよう置き換えで保存する """
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.units, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
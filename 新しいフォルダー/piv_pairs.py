@@ -0,0 +1,90 @@
+import os
+from bmp_sequence import vector_path
+
+# 画像の組の作り方
+PAIRING_CONSECUTIVE = "consecutive"  # (n, n+1) をすべての n について
+PAIRING_STRIDED = "strided"          # (n, n+stride) をすべての n について（例: 1→3, 2→4, ...）
+PAIRING_AB = "ab"                    # ダブルフレーム撮影: (1, 2), (3, 4), ... 各画像は1つの組にだけ入る
+PAIRING_SLIDING = "sliding"          # (n, n+1), (n, n+2), ..., (n, n+span) をすべての n について
+
+PAIRING_MODES = (PAIRING_CONSECUTIVE, PAIRING_STRIDED, PAIRING_AB, PAIRING_SLIDING)
+
+
+def plan_pairs(first_number, final_num, mode=PAIRING_CONSECUTIVE, stride=1, span=1, missing=()):
+    """
+    番号 first_number .. final_num の画像から、mode の方法で画像の組 (a, b) の一覧を作る。
+    欠番（missing）を含む組は除く。組は a、b の順に並ぶ。
+    """
+    if mode == PAIRING_CONSECUTIVE:
+        lags, starts = (1,), range(first_number, final_num)
+    elif mode == PAIRING_STRIDED:
+        lags, starts = (stride,), range(first_number, final_num)
+    elif mode == PAIRING_AB:
+        lags, starts = (1,), range(first_number, final_num, 2)
+    elif mode == PAIRING_SLIDING:
+        lags, starts = tuple(range(1, span + 1)), range(first_number, final_num)
+    else:
+        raise ValueError(f"未対応の組の作り方です: {mode}")
+
+    missing = set(missing)
+    return [(a, a + lag) for a in starts for lag in lags
+            if a + lag <= final_num and a not in missing and a + lag not in missing]
+
+
+def frame_schedule(pairs):
+    """
+    組の一覧から、読み込む画像の番号（初めて使う順・重複なし）と、各画像を最後に使う組の位置を返す。
+    画像は初めて使うときに1回だけ読み、最後に使う組を処理したら手放せばよい。
+    """
+    order = []
+    last_use = {}
+    for i, pair in enumerate(pairs):
+        for number in pair:
+            if number not in last_use:
+                order.append(number)
+            last_use[number] = i
+    return order, last_use
+
+
+def pair_lags(pairs):
+    """ 組に含まれる時間間隔（番号の差）の一覧 """
+    return sorted({b - a for a, b in pairs})
+
+
+def lag_folder(b_savefolder_pass, lag, lags):
+    """ 時間間隔 lag の結果を保存するフォルダ。間隔が複数ある計画（スライディング）では lag{lag} に分ける """
+    return os.path.join(b_savefolder_pass, f"lag{lag}") if len(lags) > 1 else b_savefolder_pass
+
+
+def pair_vector_path(b_savefolder_pass, name, pair, lags):
+    """
+    組 (a, b) のベクトルファイルのパス。ファイル名は a の番号で付ける（連続の組では従来と同じ名前）。
+    保存先は lag_folder 参照。
+    """
+    a, b = pair
+    return vector_path(lag_folder(b_savefolder_pass, b - a, lags), name, a)
+
+
+def ensemble_path(b_savefolder_pass, name, lag, lags):
+    """ 時間間隔 lag の組のアンサンブル相関で求めた平均場のファイルのパス """
+    return os.path.join(lag_folder(b_savefolder_pass, lag, lags), f"{name}_ensemble.txt")
+
+
+def split_pairs(pairs, pairs_per_task):
+    """ 組の一覧をワーカー用に pairs_per_task 組ずつに分ける（分け目以外では画像を共有したまま） """
+    return [pairs[i:i + pairs_per_task] for i in range(0, len(pairs), pairs_per_task)]
+
+
+def consecutive_runs(pairs):
+    """
+    (n, n+1) の組を、n が連続する区間 (最初の n, 最後の n) にまとめる（区間を指定して処理する PIV ソフト向け）。
+    間隔が1でない組は含めない。
+    """
+    starts = sorted({a for a, b in pairs if b - a == 1})
+    runs = []
+    for a in starts:
+        if runs and runs[-1][1] == a - 1:
+            runs[-1][1] = a
+        else:
+            runs.append([a, a])
+    return [tuple(run) for run in runs]
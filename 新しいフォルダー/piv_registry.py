@@ -0,0 +1,102 @@
+import os
+import sqlite3
+from datetime import datetime
+
+# 実行記録のファイル名（複数のランチャーから同時に使えるよう SQLite の WAL モードで開く）
+REGISTRY_NAME = "piv_instances.sqlite3"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    experiment TEXT,
+    temp_folder TEXT,
+    pid INTEGER,
+    bpass TEXT,
+    name TEXT,
+    final_num INTEGER,
+    b_savefolder_pass TEXT,
+    status TEXT NOT NULL,
+    returncode INTEGER,
+    started_at TEXT NOT NULL,
+    finished_at TEXT
+);
+CREATE INDEX IF NOT EXISTS instances_status ON instances (status);
+CREATE INDEX IF NOT EXISTS instances_experiment ON instances (experiment, status);
+"""
+
+_COLUMNS = ("id", "experiment", "temp_folder", "pid", "bpass", "name", "final_num", "b_savefolder_pass",
+            "status", "returncode", "started_at", "finished_at")
+
+
+def _now():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+class InstanceRegistry:
+    """
+    PIV インスタンスの実行記録。1件の追加・状態の更新はそれぞれ1つのトランザクションで、
+    記録の件数に関係なく一定の手間で済む（JSON 全体の読み書きをしない）。
+    status は running → finished / failed / exited（終了コード不明で終わっていた）と変わる。
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30.0)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, pid, bpass, name, final_num, b_savefolder_pass, temp_folder=None, experiment=None):
+        """ 起動したインスタンスを running として記録し、記録の id を返す """
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO instances (experiment, temp_folder, pid, bpass, name, final_num, b_savefolder_pass, status, started_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, 'running', ?)",
+                (experiment, temp_folder, pid, bpass, name, final_num, b_savefolder_pass, _now()))
+        return cursor.lastrowid
+
+    def update_status(self, instance_id, status, returncode=None):
+        """ 記録 instance_id の状態を更新する。running 以外は終了時刻も記録する """
+        finished_at = None if status == "running" else _now()
+        with self.connection:
+            self.connection.execute(
+                "UPDATE instances SET status = ?, returncode = ?, finished_at = ? WHERE id = ?",
+                (status, returncode, finished_at, instance_id))
+
+    def query(self, status=None, experiment=None):
+        """ 状態・実験（親フォルダ）で絞り込んだ記録を新しい順に返す """
+        conditions = []
+        values = []
+        if status is not None:
+            conditions.append("status = ?")
+            values.append(status)
+        if experiment is not None:
+            conditions.append("experiment = ?")
+            values.append(experiment)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self.connection.execute(f"SELECT * FROM instances{where} ORDER BY id DESC", values)
+        return [dict(row) for row in rows]
+
+    def running(self, experiment=None):
+        return self.query("running", experiment)
+
+    def cleanup_finished(self, is_process_running):
+        """
+        running のまま残っている記録のうち、プロセスが終わっているものを exited にする。
+        確認するのは running の記録だけで、過去の記録は読まない。
+        """
+        for row in self.running():
+            if not (row["pid"] and is_process_running(row["pid"])):
+                self.update_status(row["id"], "exited")
+
+    def summary(self, experiment=None):
+        """ 状態ごとの件数 {status: 件数} """
+        where = " WHERE experiment = ?" if experiment is not None else ""
+        values = [experiment] if experiment is not None else []
+        rows = self.connection.execute(f"SELECT status, COUNT(*) FROM instances{where} GROUP BY status", values)
+        return {status: count for status, count in rows}
@@ -0,0 +1,107 @@
+import os
+import re
+import numpy as np
+
+# ベクトルファイル名: 共通名 + 番号（6桁まで。例: name000123.txt, 1.txt, ...Hz_name000123.npy）
+VECTOR_PATTERN = re.compile(r'^(.*?)(\d{1,6})\.(?:txt|npy)$')
+
+# 欠番の扱い: 連続した区間ごとに処理する / 前後のフレームから線形補間して埋める
+GAP_SPLIT = "split"
+GAP_INTERPOLATE = "interpolate"
+
+
+def has_gaps(numbers):
+    """ 昇順の番号 numbers に欠番があれば True """
+    return len(numbers) > 0 and numbers[-1] - numbers[0] + 1 != len(numbers)
+
+
+def sequence_index(file_names, pattern=VECTOR_PATTERN):
+    """
+    連番ファイル名の一覧から、番号の抜けと重複を調べる。
+    {"name", "numbers", "files", "missing", "duplicates", "unmatched"} を返す。
+    - numbers: 番号（昇順・重複なし）、files: 各番号に使うファイル（重複時は名前順で最初のもの）
+    - missing: first〜last のうち欠けている番号、duplicates: {番号: 同じ番号のファイル}
+    - unmatched: 連番の形式に合わないファイル
+    """
+    by_number = {}
+    unmatched = []
+    for file in sorted(file_names):
+        match = pattern.match(os.path.basename(file))
+        if not match:
+            unmatched.append(file)
+            continue
+        by_number.setdefault(int(match.group(2)), []).append((match.group(1), file))
+
+    numbers = sorted(by_number)
+    missing = []
+    if has_gaps(numbers):
+        present = np.zeros(numbers[-1] - numbers[0] + 1, dtype=bool)
+        present[np.asarray(numbers) - numbers[0]] = True
+        missing = (np.flatnonzero(~present) + numbers[0]).tolist()
+
+    return {
+        "name": by_number[numbers[0]][0][0] if numbers else None,
+        "numbers": numbers,
+        "files": [by_number[number][0][1] for number in numbers],
+        "missing": missing,
+        "duplicates": {number: [file for _, file in entries] for number, entries in by_number.items() if len(entries) > 1},
+        "unmatched": unmatched,
+    }
+
+
+def format_ranges(numbers):
+    """ [3, 4, 5, 9] → "3-5, 9" """
+    numbers = sorted(numbers)
+    if not numbers:
+        return ""
+    ranges = []
+    start = prev = numbers[0]
+    for number in numbers[1:]:
+        if number != prev + 1:
+            ranges.append(f"{start}-{prev}" if prev > start else f"{start}")
+            start = number
+        prev = number
+    ranges.append(f"{start}-{prev}" if prev > start else f"{start}")
+    return ", ".join(ranges)
+
+
+def print_sequence_report(index, label=""):
+    """ 欠番・重複・形式に合わないファイルを表示する。問題がなければ何も表示しない """
+    prefix = f"{label}: " if label else ""
+    if index["missing"]:
+        print(f"{prefix}欠番 {len(index['missing'])} 個: {format_ranges(index['missing'])}")
+    for number, files in index["duplicates"].items():
+        print(f"{prefix}番号 {number} が重複しています（{files[0]} を使用）: {', '.join(files)}")
+    if index["unmatched"]:
+        print(f"{prefix}連番の形式でないファイル {len(index['unmatched'])} 個を除外しました")
+
+
+def contiguous_segments(numbers):
+    """ 番号が1ずつ続く区間を、numbers 内の位置の slice のリストで返す """
+    numbers = np.asarray(numbers)
+    breaks = (np.flatnonzero(np.diff(numbers) != 1) + 1).tolist()
+    edges = [0] + breaks + [len(numbers)]
+    return [slice(start, stop) for start, stop in zip(edges[:-1], edges[1:])]
+
+
+def fill_gaps(values, numbers, axis=0):
+    """
+    values の axis（時間軸, 番号 numbers のフレーム）の欠番を前後のフレームから線形補間し、
+    番号が連続した配列にする。(補間後の配列, 補間後の番号, 元のフレームの位置) を返す。
+    """
+    numbers = np.asarray(numbers)
+    full = np.arange(numbers[0], numbers[-1] + 1)
+    position = numbers - numbers[0]
+
+    values = np.moveaxis(values, axis, 0)
+    filled = np.empty((len(full),) + values.shape[1:], dtype=np.result_type(values, np.float64))
+    filled[position] = values
+
+    gaps = np.setdiff1d(full, numbers)
+    if len(gaps):
+        right = np.searchsorted(numbers, gaps)
+        left = right - 1
+        weight = ((gaps - numbers[left]) / (numbers[right] - numbers[left])).reshape((-1,) + (1,) * (values.ndim - 1))
+        filled[gaps - numbers[0]] = values[left] * (1 - weight) + values[right] * weight
+
+    return np.moveaxis(filled, 0, axis), full, position
@@ -0,0 +1,154 @@
+import re
+import numpy as np
+from scipy import signal
+from piv_io import format_rows
+from piv_sequence import has_gaps, contiguous_segments, fill_gaps, GAP_SPLIT, GAP_INTERPOLATE
+
+PSD_MAPS_HEADER = "x  y  dominant_freq  band_energy  forcing_amplitude"
+PSD_MAPS_TEXT_FORMAT = "  ".join(["%g"] * 2 + ["%.8e"] * 3)
+
+
+def forcing_frequency_from_name(name):
+    """
+    フォルダ名（例: 10.0Hz_14.5Lmin_C001H001S0001）から加振周波数を読み取る。見つからなければ None。
+    """
+    match = re.search(r"(\d+(?:\.\d+)?)Hz", name)
+    return float(match.group(1)) if match else None
+
+
+def welch_psd(values, time_interval, nperseg=256, axis=0):
+    """
+    values の axis 方向（時間軸）について、全格子点の Welch 平均 PSD を一度に求める。
+    (周波数, PSD) を返す。PSD の時間軸は周波数軸に置き換わる。
+    """
+    nperseg = min(nperseg, values.shape[axis])
+    return signal.welch(values, fs=1.0 / time_interval, window="hann", nperseg=nperseg,
+                        axis=axis, detrend="constant")
+
+
+def welch_psd_gaps(values, time_interval, nperseg=256, numbers=None, gaps=GAP_SPLIT):
+    """
+    時間軸が先頭の values の Welch PSD。numbers（各フレームの番号）に欠番があるとき、
+    - GAP_SPLIT: 番号が連続した区間ごとに PSD を求め、各区間の Welch セグメント数で重み付け平均する
+      （nperseg より短い区間は使わない）
+    - GAP_INTERPOLATE: 欠番を前後のフレームから線形補間して埋めてから PSD を求める
+    (周波数, PSD, 実際のセグメント長) を返す。
+    """
+    if numbers is None or not has_gaps(numbers):
+        nperseg = min(nperseg, len(values))
+        return (*welch_psd(values, time_interval, nperseg), nperseg)
+
+    if gaps == GAP_INTERPOLATE:
+        filled, _, _ = fill_gaps(values, numbers)
+        nperseg = min(nperseg, len(filled))
+        return (*welch_psd(filled, time_interval, nperseg), nperseg)
+
+    segments = contiguous_segments(numbers)
+    nperseg = min(nperseg, max(segment.stop - segment.start for segment in segments))
+    step = nperseg - nperseg // 2  # welch の既定の重なり（半分）
+    freq = psd = None
+    total = 0
+    for segment in segments:
+        length = segment.stop - segment.start
+        if length < nperseg:
+            continue
+        count = (length - nperseg) // step + 1
+        freq, segment_psd = welch_psd(values[segment], time_interval, nperseg)
+        psd = segment_psd * count if psd is None else psd + segment_psd * count
+        total += count
+    return freq, psd / total, nperseg
+
+
+def psd_to_amplitude(psd, time_interval, nperseg):
+    """
+    Welch の PSD（密度）を正弦波の振幅に換算する（hann 窓のパワースペクトル → 振幅）。
+    """
+    window = signal.get_window("hann", nperseg)
+    power = psd * (window ** 2).sum() / (time_interval * window.sum() ** 2)
+    return np.sqrt(2.0 * power)
+
+
+def spectral_maps(freq, psd, time_interval, nperseg, band, forcing_freq):
+    """
+    PSD (周波数, ...) から格子点ごとの代表値を求める。
+    - 卓越周波数（直流成分を除いたピーク）
+    - band = (下限, 上限) Hz の帯域エネルギー
+    - 加振周波数に最も近いビンでの振幅
+    """
+    dominant = freq[1:][np.argmax(psd[1:], axis=0)] if len(freq) > 1 else np.zeros(psd.shape[1:])
+
+    df = freq[1] - freq[0] if len(freq) > 1 else 0.0
+    in_band = (freq >= band[0]) & (freq <= band[1])
+    band_energy = psd[in_band].sum(axis=0) * df
+
+    if forcing_freq is None:
+        forcing_amplitude = np.full(psd.shape[1:], np.nan)
+    else:
+        k = int(np.argmin(np.abs(freq - forcing_freq)))
+        forcing_amplitude = psd_to_amplitude(psd[k], time_interval, nperseg)
+
+    return dominant, band_energy, forcing_amplitude
+
+
+def save_spectral_cube(output_path, freq, psd, x, y):
+    """ 全格子点の PSD（周波数, 格子行, 格子列）を座標と一緒に保存する """
+    np.savez(output_path, freq=freq, psd=psd, x=x, y=y)
+
+
+def save_spectral_maps(output_path, x, y, dominant, band_energy, forcing_amplitude):
+    """ 格子点ごとの卓越周波数・帯域エネルギー・加振周波数の振幅を書き出す """
+    grid_x, grid_y = np.meshgrid(x, y)
+    table = np.column_stack([grid_x.ravel(), grid_y.ravel(), dominant.ravel(),
+                             band_energy.ravel(), forcing_amplitude.ravel()])
+    with open(output_path, "w") as file:
+        file.write(f"# {PSD_MAPS_HEADER}\n")
+        file.write(format_rows(table, PSD_MAPS_TEXT_FORMAT))
+
+
+class StreamingWelch:
+    """
+    フレームが届くたびに加えて、Welch 平均 PSD（hann 窓・半分重なり・平均除去）を逐次更新する。
+    1フレームあたりの処理はバッファへのコピーだけで、セグメント（nperseg フレーム）が
+    揃ったときだけそのセグメントを FFT して足し込む。過去のセグメントは計算し直さない。
+    番号が飛んだときは途中のセグメントを捨てて新しく始める（welch_psd_gaps の GAP_SPLIT と同じ）。
+    """
+
+    def __init__(self, time_interval, nperseg=256, shape=()):
+        self.time_interval = time_interval
+        self.nperseg = nperseg
+        self.step = nperseg - nperseg // 2
+        self.window = signal.get_window("hann", nperseg).reshape((nperseg,) + (1,) * len(shape))
+        self.scale = time_interval / (self.window ** 2).sum()  # 密度（/Hz）への換算
+        self.freq = np.fft.rfftfreq(nperseg, time_interval)
+        self.buffer = np.zeros((nperseg,) + tuple(shape))
+        self.filled = 0
+        self.psd_sum = np.zeros((len(self.freq),) + tuple(shape))
+        self.segments = 0
+        self.frames = 0
+        self.last_number = None
+
+    def add(self, values, number=None):
+        """ 1フレーム分の値を加える。セグメントが揃えば PSD に足し込む """
+        if number is not None and self.last_number is not None and number != self.last_number + 1:
+            self.filled = 0
+        self.last_number = number
+
+        self.buffer[self.filled] = values
+        self.filled += 1
+        self.frames += 1
+        if self.filled == self.nperseg:
+            self._add_segment()
+            self.buffer[:self.nperseg - self.step] = self.buffer[self.step:]
+            self.filled = self.nperseg - self.step
+
+    def _add_segment(self):
+        segment = self.buffer - self.buffer.mean(axis=0)
+        power = np.abs(np.fft.rfft(segment * self.window, axis=0)) ** 2 * self.scale
+        # 片側スペクトル: 直流と（偶数長のとき）ナイキストのビン以外を2倍する
+        power[1:len(self.freq) - (self.nperseg % 2 == 0)] *= 2
+        self.psd_sum += power
+        self.segments += 1
+
+    def psd(self):
+        """ (周波数, 平均 PSD) を返す。まだセグメントが1つもなければ PSD は None """
+        return self.freq, (self.psd_sum / self.segments if self.segments else None)
@@ -0,0 +1,131 @@
+import numpy as np
+from piv_io import load_frame, format_rows
+
+# 統計をとる成分の並び（フレームの x, y を除いた列: u, v, 速さ, フラグ, 7・8 列目）
+STAT_U, STAT_V = 0, 1
+
+STATISTICS_HEADER = "x  y  mean_u  mean_v  std_u  std_v  rms_u  rms_v  uu  vv  uv  count"
+STATISTICS_TEXT_FORMAT = "  ".join(["%g"] * 2 + ["%.8e"] * 9 + ["%d"])
+
+
+class StreamingStats:
+    """
+    1フレームずつ加えて、格子点ごとの平均・分散・レイノルズ応力を1パスで求める（Welford法）。
+    有効サンプル数は格子点ごとに数えるので、欠損やマスクがあっても平均が偏らない。
+    """
+
+    def __init__(self, shape):
+        self.num_frames = 0
+        self.count = np.zeros(shape[0], dtype=np.int64)
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+        self.cross_uv = np.zeros(shape[0], dtype=np.float64)
+
+    def add(self, values, valid=None):
+        """
+        1フレーム分の値 (格子点, 成分) を加える。valid は格子点ごとの有効フラグ。
+        """
+        if valid is None:
+            valid = np.isfinite(values).all(axis=1)
+        weight = valid.astype(np.float64)
+        values = np.where(valid[:, None], values, 0.0)
+
+        self.num_frames += 1
+        self.count += valid
+        n = np.maximum(self.count, 1)[:, None]
+        delta = (values - self.mean) * weight[:, None]
+        self.mean += delta / n
+        delta_after = (values - self.mean) * weight[:, None]
+        self.m2 += delta * delta_after
+        self.cross_uv += delta[:, STAT_U] * delta_after[:, STAT_V]
+
+    def merge(self, other):
+        """
+        別の StreamingStats（部分和）を統合する。同じ順序で統合すれば結果は毎回同じになる。
+        """
+        n_a = self.count[:, None].astype(np.float64)
+        n_b = other.count[:, None].astype(np.float64)
+        n = np.maximum(n_a + n_b, 1)
+        delta = other.mean - self.mean
+
+        self.mean += delta * n_b / n
+        self.m2 += other.m2 + delta ** 2 * n_a * n_b / n
+        self.cross_uv += other.cross_uv + delta[:, STAT_U] * delta[:, STAT_V] * (n_a * n_b / n)[:, 0]
+        self.count += other.count
+        self.num_frames += other.num_frames
+        return self
+
+    def variance(self, ddof=0):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.m2 / (self.count - ddof)[:, None]
+
+    @property
+    def std(self):
+        """ 標準偏差（不偏） """
+        return np.sqrt(self.variance(ddof=1))
+
+    @property
+    def rms(self):
+        """ 変動成分の RMS """
+        return np.sqrt(self.variance(ddof=0))
+
+    def reynolds_stresses(self):
+        """ u'u', v'v', u'v' を返す """
+        variance = self.variance(ddof=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            uv = self.cross_uv / self.count
+        return variance[:, STAT_U], variance[:, STAT_V], uv
+
+    def averaged(self):
+        """ 有効サンプルがない格子点は NaN にした平均 """
+        return np.where(self.count[:, None] > 0, self.mean, np.nan)
+
+
+def save_statistics(output_path, grid_xy, stats):
+    """
+    格子点ごとの統計量を書き出す。
+    """
+    uu, vv, uv = stats.reynolds_stresses()
+    mean = stats.averaged()
+    std = stats.std
+    rms = stats.rms
+
+    table = np.column_stack([grid_xy, mean[:, STAT_U], mean[:, STAT_V], std[:, STAT_U], std[:, STAT_V],
+                             rms[:, STAT_U], rms[:, STAT_V], uu, vv, uv, stats.count])
+
+    with open(output_path, 'w') as file:
+        file.write(f"# {STATISTICS_HEADER}\n")
+        file.write(format_rows(table, STATISTICS_TEXT_FORMAT))
+
+
+def accumulate_frames(file_paths, validator=None, grid_xy=None):
+    """
+    ファイルを順に1つずつ読み、StreamingStats に加える。
+    validator（piv_validate.VectorValidator）を渡すと、マスクされた点と外れ値を統計から除く。
+    読めないファイル（0 バイト・書き込み途中など）と、格子(x, y)が基準と異なるファイルはスキップする。
+    基準の格子 grid_xy を省くと最初に読めたファイルの格子を使う（分割して並列に処理するときは全体で同じ基準を渡す）。
+    (格子の x, y, 統計量, スキップしたファイル) を返す。読めるファイルがなければ統計量は None。
+    """
+    stats = None
+    skipped = []
+
+    for file_path in file_paths:
+        try:
+            data = load_frame(file_path)
+        except (ValueError, OSError):
+            skipped.append(file_path)
+            continue
+        if grid_xy is None:
+            grid_xy = data[:, :2].copy()
+        elif len(data) != len(grid_xy) or not np.array_equal(data[:, :2], grid_xy):
+            skipped.append(file_path)
+            continue
+        if stats is None:
+            stats = StreamingStats((len(data), data.shape[1] - 2))
+        if validator is None:
+            stats.add(data[:, 2:])
+        else:
+            data, valid, _ = validator.frame(data)
+            stats.add(data[:, 2:], valid)
+
+    return grid_xy, stats, skipped
@@ -0,0 +1,187 @@
+import numpy as np
+from piv_cube import infer_grid, COL_U, COL_V, COL_SPEED, COL_FLAG, COMPONENT_COLUMNS
+
+# 正規化メディアン検定（Westerweel & Scarano 2005）のしきい値と、ばらつきが小さい領域のための下限値
+MEDIAN_THRESHOLD = 2.0
+MEDIAN_EPSILON = 0.1
+# フラグの列でマスクされた点（壁・流れの外など）の値
+FLAG_MASKED = -1.0
+# 外れ値を周囲の有効なベクトルの平均で埋める繰り返し回数（外れ値が固まっている所は外側から埋まる）
+REPLACE_ITERATIONS = 3
+# 時系列をまとめて検証するときに一度に扱うフレーム数（近傍の配列の作業メモリを抑える）
+FRAMES_PER_BATCH = 64
+
+# 3x3 近傍のうち中心を除く8点
+_OFFSETS = [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if (dy, dx) != (0, 0)]
+
+
+def _neighbours(field):
+    """
+    (..., 格子行, 格子列) の場から 3x3 近傍の8点を先頭の軸に並べた配列を作る。格子の外は NaN。
+    """
+    ny, nx = field.shape[-2:]
+    padded = np.pad(field.astype(np.float64), [(0, 0)] * (field.ndim - 2) + [(1, 1), (1, 1)],
+                    constant_values=np.nan)
+    return np.stack([padded[..., 1 + dy:1 + dy + ny, 1 + dx:1 + dx + nx] for dy, dx in _OFFSETS])
+
+
+def _nanmedian(values):
+    """
+    先頭の軸（近傍の8点）の NaN を除いた中央値。np.nanmedian より速い（並べ替えると NaN は末尾に来る）。
+    有効な値がなければ NaN。
+    """
+    ordered = np.sort(values, axis=0)
+    count = (~np.isnan(values)).sum(axis=0, keepdims=True)
+    lower = np.take_along_axis(ordered, np.maximum((count - 1) // 2, 0), axis=0)
+    upper = np.take_along_axis(ordered, count // 2, axis=0)
+    return ((lower + upper) / 2)[0]
+
+
+def _neighbour_median_residual(field, epsilon):
+    """ 近傍の中央値からのずれを、近傍のばらつき（中央値からのずれの中央値）+ epsilon で割ったもの """
+    neighbours = _neighbours(field)
+    median = _nanmedian(neighbours)
+    spread = _nanmedian(np.abs(neighbours - median))
+    with np.errstate(invalid="ignore"):
+        return np.abs(field - median) / (spread + epsilon)  # 有効な近傍がない点は NaN（検定しない）
+
+
+def normalized_median_test(u, v, valid=None, threshold=MEDIAN_THRESHOLD, epsilon=MEDIAN_EPSILON):
+    """
+    正規化メディアン検定。u, v は (..., 格子行, 格子列)（1フレームでも時系列でもよい）。
+    近傍の中央値には valid が True の点だけを使う。u, v のどちらかが threshold を超えた点を外れ値として返す。
+    """
+    if valid is not None:
+        u = np.where(valid, u, np.nan)
+        v = np.where(valid, v, np.nan)
+    with np.errstate(invalid="ignore"):
+        outlier = ((_neighbour_median_residual(u, epsilon) > threshold) |
+                   (_neighbour_median_residual(v, epsilon) > threshold))
+    return outlier if valid is None else outlier & valid
+
+
+def range_test(u, v, u_range=None, v_range=None, speed_max=None):
+    """ u, v が (下限, 上限) の外、または速さが speed_max を超える点を外れ値として返す（None の条件は使わない） """
+    outlier = ~(np.isfinite(u) & np.isfinite(v))
+    if u_range is not None:
+        outlier |= (u < u_range[0]) | (u > u_range[1])
+    if v_range is not None:
+        outlier |= (v < v_range[0]) | (v > v_range[1])
+    if speed_max is not None:
+        outlier |= np.hypot(u, v) > speed_max
+    return outlier
+
+
+def flag_mask(flag):
+    """ フラグの列が -1（マスク）の点 """
+    return flag == FLAG_MASKED
+
+
+def replace_outliers(u, v, valid, outliers, iterations=REPLACE_ITERATIONS):
+    """
+    外れ値を 3x3 近傍の有効なベクトルの平均で置き換えた u, v を返す（元の配列は変えない）。
+    埋めた点は次の繰り返しで近傍として使う。iterations 回で埋まらなかった点は NaN。
+    """
+    u = np.where(valid, u, np.nan)
+    v = np.where(valid, v, np.nan)
+    for _ in range(iterations):
+        missing = outliers & np.isnan(u)
+        if not missing.any():
+            break
+        neighbours_u = _neighbours(u)
+        neighbours_v = _neighbours(v)
+        count = np.isfinite(neighbours_u).sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_u = np.nansum(neighbours_u, axis=0) / count
+            mean_v = np.nansum(neighbours_v, axis=0) / count
+        fill = missing & (count > 0)
+        u[fill] = mean_u[fill]
+        v[fill] = mean_v[fill]
+    return u, v
+
+
+class VectorValidator:
+    """
+    ベクトル場の検証条件。フラグのマスク → 値の範囲 → 正規化メディアン検定 の順に外れ値を判定し、
+    外れ値は近傍の平均で置き換える（マスクされた点は置き換えない）。
+    置き換えられなかった点はフラグを -1 にする。どの点を置き換えたかはフレームの列には書かず、
+    有効な点の配列と一緒に返す（7, 8 列目には PIV ソフトの値が入っているので上書きしない）。
+    """
+
+    def __init__(self, threshold=MEDIAN_THRESHOLD, epsilon=MEDIAN_EPSILON, u_range=None, v_range=None,
+                 speed_max=None, iterations=REPLACE_ITERATIONS):
+        self.threshold = threshold
+        self.epsilon = epsilon
+        self.u_range = u_range
+        self.v_range = v_range
+        self.speed_max = speed_max
+        self.iterations = iterations
+        self._grid = None
+
+    def params(self):
+        """ 処理記録（マニフェスト）に残す条件 """
+        return {"threshold": self.threshold, "epsilon": self.epsilon, "u_range": self.u_range,
+                "v_range": self.v_range, "speed_max": self.speed_max, "iterations": self.iterations}
+
+    def grid(self, values):
+        """
+        格子に並べた値 (..., 格子行, 格子列, 成分) をその場で検証する（成分は x, y を除いた列）。
+        (有効な点（マスクでも外れ値でもない点）, 近傍から置き換えた点) の配列 (..., 格子行, 格子列) を返す。
+        """
+        u = values[..., COL_U - 2]
+        v = values[..., COL_V - 2]
+        flag = values[..., COL_FLAG - 2]
+
+        valid = ~flag_mask(flag) & ~range_test(u, v, self.u_range, self.v_range, self.speed_max)
+        valid &= ~normalized_median_test(u, v, valid, self.threshold, self.epsilon)
+        outliers = ~valid & ~flag_mask(flag)
+
+        new_u, new_v = replace_outliers(u, v, valid, outliers, self.iterations)
+        replaced = outliers & np.isfinite(new_u)
+        unreplaced = outliers & ~replaced
+        u[replaced] = new_u[replaced]
+        v[replaced] = new_v[replaced]
+        values[..., COL_SPEED - 2][replaced] = np.hypot(new_u[replaced], new_v[replaced])
+        values[unreplaced, COL_U - 2:COL_SPEED - 2 + 1] = 0.0
+        flag[unreplaced] = FLAG_MASKED
+        return valid, replaced
+
+    def frame(self, frame):
+        """
+        1フレーム (行数, 8) を検証する。(検証したフレームのコピー, 行ごとの有効フラグ, 行ごとの置き換えフラグ) を返す。
+        格子は前のフレームと x, y が同じなら推定し直さない。
+        """
+        xy = frame[:, :2]
+        if self._grid is None or not np.array_equal(self._grid[0], xy):
+            x, y, cells = infer_grid(frame)
+            self._grid = (xy.copy(), len(y), len(x), cells)
+        _, ny, nx, cells = self._grid
+
+        values = np.zeros((ny * nx, COMPONENT_COLUMNS), dtype=frame.dtype)
+        values[cells] = frame[:, 2:]
+        values = values.reshape(ny, nx, COMPONENT_COLUMNS)
+        valid, replaced = self.grid(values)
+
+        out = frame.copy()
+        out[:, 2:] = values.reshape(-1, COMPONENT_COLUMNS)[cells]
+        return out, valid.ravel()[cells], replaced.ravel()[cells]
+
+    def cube(self, cube):
+        """
+        VelocityCube の全フレームをその場で検証し、(有効な点, 置き換えた点) の配列 (時間, 格子行, 格子列) を返す。
+        FRAMES_PER_BATCH フレームずつまとめて配列演算する。
+        """
+        valid = np.empty(cube.data.shape[:3], dtype=bool)
+        replaced = np.empty_like(valid)
+        for start in range(0, len(cube.data), FRAMES_PER_BATCH):
+            frames = slice(start, start + FRAMES_PER_BATCH)
+            valid[frames], replaced[frames] = self.grid(cube.data[frames])
+        return valid, replaced
+
+
+def print_validation_summary(valid, label="", replaced=None):
+    """ 有効な点の割合（と近傍から置き換えた点の数）を表示する """
+    prefix = f"{label}: " if label else ""
+    suffix = f"、近傍から置き換えた点 {replaced.sum()}" if replaced is not None else ""
+    print(f"{prefix}有効なベクトル {valid.sum()} / {valid.size} ({100 * valid.mean():.1f}%){suffix}")
+
@@ -0,0 +1,257 @@
+import os
+import time
+import numpy as np
+from bmp_sequence import vector_path, available_pairs
+from piv_cube import load_cube, cube_numbers
+from piv_filter import lowpass_cube
+from piv_io import save_frame, save_frames, AVERAGED_TEXT_FORMAT
+from piv_stats import accumulate_frames, save_statistics
+from piv_sequence import sequence_index, VECTOR_PATTERN, GAP_SPLIT
+
+# ファイル数・サイズ・更新時刻がこの時間（秒）変わらなければ書き込みが終わったとみなす
+DEFAULT_STABLE_SECONDS = 10.0
+
+# 保存先フォルダを確認する間隔（秒）
+DEFAULT_POLL_INTERVAL = 5.0
+
+# 1つのフレームファイルのサイズ・更新時刻がこの時間（秒）変わらなければ書き込みが終わったとみなす
+DEFAULT_FRAME_STABLE_SECONDS = 2.0
+
+
+def expected_vector_files(b_savefolder_pass, name, first_number, final_num, missing=()):
+    """ 画像の組 (n, n+1), n = first_number .. final_num-1 から作られるはずのベクトルファイル（欠番を含む組は除く） """
+    return [vector_path(b_savefolder_pass, name, number) for number in available_pairs(first_number, final_num, missing)]
+
+
+class FolderWatch:
+    """
+    1つの保存先フォルダ（b_savefolder_pass）の監視状態。
+    """
+
+    def __init__(self, b_savefolder_pass, name, first_number, final_num, missing=()):
+        self.folder = b_savefolder_pass
+        self.name = name
+        self.file_paths = expected_vector_files(b_savefolder_pass, name, first_number, final_num, missing)
+        self.expected_names = {os.path.basename(path) for path in self.file_paths}
+        self.signature = None
+        self.stable_since = None
+        self.found = 0
+        self.done = False
+
+    def check(self, now, stable_seconds):
+        """
+        フォルダを1回走査し、予定のファイルがすべて揃って stable_seconds 以上変化していなければ True。
+        """
+        found = 0
+        total_size = 0
+        latest_mtime = 0
+        try:
+            with os.scandir(self.folder) as entries:
+                for entry in entries:
+                    if entry.name in self.expected_names:
+                        stat = entry.stat()
+                        found += 1
+                        total_size += stat.st_size
+                        latest_mtime = max(latest_mtime, stat.st_mtime_ns)
+        except FileNotFoundError:
+            pass
+
+        self.found = found
+        signature = (found, total_size, latest_mtime)
+        if signature != self.signature:
+            self.signature = signature
+            self.stable_since = now
+            return False
+
+        return found == len(self.expected_names) and now - self.stable_since >= stable_seconds
+
+
+class CompletionWatcher:
+    """
+    複数の保存先フォルダを監視し、ベクトルファイルが揃って増えなくなったフォルダを順に知らせる。
+    """
+
+    def __init__(self, stable_seconds=DEFAULT_STABLE_SECONDS, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.stable_seconds = stable_seconds
+        self.poll_interval = poll_interval
+        self.watches = []
+
+    def watch(self, b_savefolder_pass, name, first_number, final_num, missing=()):
+        """ 監視するフォルダを加える。missing は画像の欠番 """
+        folder_watch = FolderWatch(b_savefolder_pass, name, first_number, final_num, missing)
+        self.watches.append(folder_watch)
+        return folder_watch
+
+    @property
+    def pending(self):
+        return [w for w in self.watches if not w.done]
+
+    def poll(self):
+        """ 全フォルダを1回確認し、今回完了と判定したフォルダを返す """
+        now = time.monotonic()
+        completed = []
+        for folder_watch in self.pending:
+            if folder_watch.check(now, self.stable_seconds):
+                folder_watch.done = True
+                completed.append(folder_watch)
+        return completed
+
+    def run(self, on_complete, idle_timeout=None, max_wait=None):
+        """
+        すべてのフォルダが完了するまで監視し、完了したフォルダごとに on_complete(watch) を呼ぶ。
+        どのフォルダのファイルも idle_timeout 秒変化しないとき、または監視を始めて max_wait 秒たったときは
+        途中で打ち切る（None なら打ち切らない）。完了しなかったフォルダを返す。
+        """
+        started = time.monotonic()
+        while self.pending:
+            for folder_watch in self.poll():
+                on_complete(folder_watch)
+            if not self.pending:
+                break
+            now = time.monotonic()
+            if max_wait is not None and now - started >= max_wait:
+                break
+            if idle_timeout is not None and now - max(w.stable_since for w in self.watches) >= idle_timeout:
+                break
+            time.sleep(self.poll_interval)
+        return self.pending
+
+
+class FrameFollower:
+    """
+    増えていくフォルダの連番フレームファイルを、書き込みが終わったものから番号順に返す。
+    複数のワーカーが番号の離れた区間を同時に書いていても、番号順が崩れないよう次の番号が揃うまで待つ。
+    次の番号が現れないまま、それより後のファイルが gap_seconds 以上揃っていれば欠番とみなして先へ進む。
+    first_number を省くと、見えているファイルがすべて gap_seconds 以上変化しなくなってから最小の番号を最初とする
+    （後ろの区間が先に書かれても、前の区間を取りこぼさない）。
+    0 バイトのまま gap_seconds 以上変わらないファイルも、後のファイルが揃っていれば欠番とみなす。
+    """
+
+    def __init__(self, folder, first_number=None, stable_seconds=DEFAULT_FRAME_STABLE_SECONDS,
+                 gap_seconds=DEFAULT_STABLE_SECONDS):
+        self.folder = folder
+        self.next_number = first_number
+        self.stable_seconds = stable_seconds
+        self.gap_seconds = gap_seconds
+        self._seen = {}  # 番号 -> (パス, (サイズ, 更新時刻), 最後に変化を見た時刻)
+
+    def _scan(self, now):
+        found = {}
+        try:
+            with os.scandir(self.folder) as entries:
+                for entry in entries:
+                    match = VECTOR_PATTERN.match(entry.name)
+                    if not match or not entry.is_file():
+                        continue
+                    number = int(match.group(2))
+                    if self.next_number is not None and number < self.next_number:
+                        continue
+                    if number not in found or entry.name < os.path.basename(found[number].path):
+                        found[number] = entry
+        except FileNotFoundError:
+            return
+
+        for number, entry in found.items():
+            stat = entry.stat()
+            signature = (stat.st_size, stat.st_mtime_ns)
+            previous = self._seen.get(number)
+            if previous is None or previous[:2] != (entry.path, signature):
+                self._seen[number] = (entry.path, signature, now)
+
+    def _ready(self, number, now, seconds):
+        _, (size, _), since = self._seen[number]
+        return size > 0 and now - since >= seconds
+
+    def poll(self):
+        """ フォルダを1回走査し、新しく読めるようになったフレームを [(番号, パス), ...] の番号順で返す """
+        now = time.monotonic()
+        self._scan(now)
+        ready = []
+        while self._seen:
+            if self.next_number is None:
+                if any(now - since < self.gap_seconds for _, _, since in self._seen.values()):
+                    break  # まだ変化しているファイルがある（空のファイルも変化しなくなれば落ち着いたとみなす）
+                self.next_number = min(self._seen)
+            if self.next_number in self._seen:
+                if self._ready(self.next_number, now, self.stable_seconds):
+                    ready.append((self.next_number, self._seen.pop(self.next_number)[0]))
+                    self.next_number += 1
+                    continue
+                _, (size, _), since = self._seen[self.next_number]
+                later = [number for number in self._seen if number > self.next_number]
+                if size > 0 or now - since < self.gap_seconds or not later:
+                    break
+                if not self._ready(min(later), now, self.gap_seconds):
+                    break
+                del self._seen[self.next_number]  # 空のまま書かれなかったファイルを飛ばす
+                self.next_number = min(later)
+                continue
+            later = min(self._seen)
+            if not self._ready(later, now, self.gap_seconds):
+                break
+            self.next_number = later  # 欠番を飛ばす
+        return ready
+
+
+def average_outputs(output_dir, prefix):
+    """ 平均化の出力ファイル（平均値と統計量） """
+    return [os.path.join(output_dir, f"{prefix}_averaged.txt"), os.path.join(output_dir, f"{prefix}_statistics.txt")]
+
+
+def average_folder(file_paths, output_dir, prefix):
+    """ ベクトルファイルを平均化し、{prefix}_averaged.txt と {prefix}_statistics.txt を保存する """
+    grid_xy, stats, skipped = accumulate_frames(file_paths)
+    for file_path in skipped:
+        print(f"エラー: {file_path} のデータ構造が異なります。")
+    if stats is None:
+        raise ValueError(f"{prefix}: 読み込めるベクトルファイルがありません")
+
+    output_path, statistics_path = average_outputs(output_dir, prefix)
+    save_frame(output_path, np.column_stack([grid_xy, stats.averaged()]), fmt=AVERAGED_TEXT_FORMAT)
+    save_statistics(statistics_path, grid_xy, stats)
+    return output_path
+
+
+def lowpass_outputs(file_paths, output_dir, time_interval, cutoff_freq):
+    """ Low-pass filter (FFT).py と同じ名前の出力フォルダと出力ファイル """
+    file_names = [os.path.basename(path) for path in file_paths]
+    common_prefix = os.path.commonprefix(file_names).rstrip("_-. ")
+    output_folder_path = os.path.join(output_dir, f"{time_interval:.5f}sec_lp{cutoff_freq:.2f}Hz_{common_prefix}")
+    return output_folder_path, [os.path.join(output_folder_path, f"{time_interval:.5f}sec_lp{cutoff_freq:.2f}Hz_{file}") for file in file_names]
+
+
+def lowpass_folder(file_paths, output_dir, time_interval, cutoff_freq):
+    """ ベクトルファイルを時間方向にローパスして保存する。出力フォルダを返す """
+    output_folder_path, output_paths = lowpass_outputs(file_paths, output_dir, time_interval, cutoff_freq)
+    os.makedirs(output_folder_path, exist_ok=True)
+
+    # 欠番のあるフォルダ（読めずに飛ばしたフレームを含む）は番号が連続した区間ごとにフィルタする
+    index = sequence_index([os.path.basename(path) for path in file_paths])
+    cube = load_cube(os.path.dirname(file_paths[0]), index["files"])
+    if cube is None:
+        raise ValueError(f"{os.path.dirname(file_paths[0])}: 読み込めるベクトルファイルがありません")
+    lowpass_cube(cube, time_interval, cutoff_freq, cube_numbers(cube, index["files"], index["numbers"]), GAP_SPLIT)
+    output_of = dict(zip((os.path.basename(path) for path in file_paths), output_paths))
+    save_frames([output_of[file] for file in cube.file_names], (cube.frame(t) for t in range(len(cube.file_names))))
+    return output_folder_path
+
+
+def postprocess_outputs(file_paths, name, average_dir=None, lowpass_dir=None, time_interval=None, cutoff_freq=None):
+    """ postprocess_folder が書き出すファイルの一覧 """
+    outputs = []
+    if average_dir:
+        outputs += average_outputs(average_dir, name)
+    if lowpass_dir and cutoff_freq:
+        outputs += lowpass_outputs(file_paths, lowpass_dir, time_interval, cutoff_freq)[1]
+    return outputs
+
+
+def postprocess_folder(file_paths, name, average_dir=None, lowpass_dir=None, time_interval=None, cutoff_freq=None):
+    """
+    PIV が終わったフォルダの後処理（平均化と時間方向ローパス）。指定のない処理は行わない。
+    """
+    if average_dir:
+        print(f"平均化完了: {average_folder(file_paths, average_dir, name)}")
+    if lowpass_dir and cutoff_freq:
+        print(f"ローパス完了: {lowpass_folder(file_paths, lowpass_dir, time_interval, cutoff_freq)}")
+    return name